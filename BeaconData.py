@@ -1,22 +1,41 @@
-import yaml
 import json
+import struct
 import logging
-import sdw
 import time
-from threading import Thread, Event
+from array import array
+from threading import Thread, Event, Lock
 from datetime import datetime
-from beacontools import BeaconScanner, EddystoneTLMFrame, EddystoneFilter
+from StreamingStats import valid_mode, create_estimator
+from MqttConnections import create_publisher, close_publisher
+from WindowScheduler import WindowScheduler, monotonic
+from PublishSpool import open_spool
+from WindowHistory import WindowHistory
+from Metrics import registry
 
 
 logger = logging.getLogger(__name__)
 
+ADVERTISEMENTS = registry.counter("bt_advertisements_total", "Advertisements received by the beacon callback")
+UNKNOWN = registry.counter("bt_unknown_advertisements_total", "Advertisements from unmapped beacons", ("beacon",))
+UNTRACKED = registry.counter("bt_unknown_untracked_total", "Unmapped advertisements beyond the tracked beacon ids")
+FILTERED = registry.counter("bt_filtered_advertisements_total", "Advertisements rejected by the instance allowlist")
+SAMPLES = registry.gauge("bt_beacon_window_samples", "Samples per beacon in the last closed window", ("beacon",))
+WINDOW_TIME = registry.histogram("bt_window_processing_seconds", "Time to aggregate and publish a closed window")
+WINDOW_OVERRUNS = registry.counter("bt_window_overruns_total", "Window deadlines missed because a window overran")
+SUPPRESSED = registry.counter("bt_deadband_suppressed_total", "Window values not published because of the deadband")
+PUBLISH_LATENCY = registry.histogram("bt_publish_latency_seconds", "Latency of value publications", ("path",))
+PUBLISH_FAILURES = registry.counter("bt_publish_failures_total", "Failed value publications", ("path",))
+
 
 '''
 
 Support classes for managing the publication of BLE (Eddystone) Beacons to Sensor Awareness
 
 BeaconScanAndPublish - threaded control class for capturing data and publishing them
+SensorMappings       - per sensor slots, paths, fields and modes built from the configuration
 BeaconData           - coordinates the collection of data from the beacons
+UnknownBeacons       - bounded tally of advertisements from beacons that aren't mapped
+Deadband             - report-by-exception filter deciding which window values are published
 BeaconPublisher      - support for publishing beacon data to Sensor Awareness' MQTT server
 
 '''
@@ -27,49 +46,201 @@ class BeaconScanAndPublish(Thread):
         self._stop_event = Event()
         self._running = False
         self._cfg = None
+        self._pending = None
+        self._pending_lock = Lock()
         if configFile is not None:
             self.reload_configuration(configFile)
         
 
-    def reload_configuration(self, configFile):
+    def read_configuration(self, configFile):
         with open(configFile) as fp:
             if configFile.endswith("yaml"):
+                import yaml
                 temp = yaml.safe_load(fp)
             else:
                 temp = json.load(fp)
+        cfg = temp['beacons']
 
-        self._cfg = temp['beacons']
-        self._name = self._cfg['name']
-        
-        if self._cfg['mode'] not in ['last', 'mean', 'min', 'max']:
-            logger.error("[%s] unrecognized mode: %s", str(datetime.now()), self._cfg['mode'])
-            exit()
-        
-        # sensor_lut maps UID of the sensor to the path and field name
-        self._sensor_lut = {}
-        for m in self._cfg['mappings']:
-            self._sensor_lut[m['sensor']] = {'path': m['path'], 'field': m['field']}
-
-        # list of all the sensor UIDs and paths
-        self._sensor_ids = map(lambda x: x['sensor'], self._cfg['mappings'])
-        self._sensor_paths = [ self._sensor_lut[x]['path'] for x in self._sensor_ids ]
+        # optional batching of each window's values: "path" sends one message per path,
+        # "receiver" sends one message to "batch_path" for the whole receiver
+        batch = cfg.get('batch')
+        if batch not in [None, 'path', 'receiver'] or (batch == 'receiver' and 'batch_path' not in cfg):
+            raise ValueError("unrecognized batch mode: {0}".format(batch))
+        return cfg
 
-        self._beacons = BeaconData()
-        self._publishers = BeaconPublisher(self._name)
-        self._publishers.create_pubs(self._cfg['mqtt'], self._sensor_paths)
 
-        self._logged_missing_ids = []
+    def reload_configuration(self, configFile):
+        self._cfg = self.read_configuration(configFile)
+        self._name = self._cfg['name']
+        self._mappings = SensorMappings(self._cfg)
+        self._slots = self._mappings.slots
+        self._allowed = self._mappings.allowed
+        self._track_unknown = self._cfg.get('track_unknown', True)
+
+        # the scanner callback writes to the front buffer while the closed window in
+        # the back buffer is published, the two are swapped at each window deadline
+        self._front = self._mappings.create_buffer()
+        self._back = self._mappings.create_buffer()
+        self._swap_lock = Lock()
+        self._scheduler = WindowScheduler(float(self._cfg['frequency'])/1000)
+        self._publish_time = 0.0
+
+        self._publishers = self.create_publishers(self._cfg, self._mappings.paths)
+        self._history = self.create_history(self._cfg)
+        self._unknown = UnknownBeacons()
+        self._advertisements = 0
+        self._filtered = 0
         self._scanner = None
 
 
+    # change the configuration of a running scanner, applied at the next window
+    # deadline; a stopped scanner is simply reconfigured
+    def apply_configuration(self, configFile):
+        if not self._running:
+            self.reload_configuration(configFile)
+            return
+        cfg = self.read_configuration(configFile)
+        mappings = SensorMappings(cfg)
+        buffers = (mappings.create_buffer(), mappings.create_buffer())
+        with self._pending_lock:
+            self._pending = (cfg, mappings, buffers)
+        logger.info("[%s] new configuration will be applied at the next window", str(datetime.now()))
+
+
+    def create_publishers(self, cfg, paths):
+        # every path has its own sdw.MQTT connection unless "shared_mqtt" is true
+        publishers = BeaconPublisher(cfg['name'], cfg.get('batch'), cfg.get('batch_path'),
+                                     cfg.get('shared_mqtt', False))
+        publishers.create_pubs(cfg['mqtt'], paths)
+
+        # failed publications are kept in "spool_file" and replayed when the broker is back
+        if 'spool_file' in cfg:
+            spool, replay = open_spool(cfg['spool_file'], cfg.get('spool_size', 4*1024*1024),
+                                       cfg.get('shared_mqtt', False))
+            publishers.set_spool(spool, replay)
+        return publishers
+
+
+    # closed windows are also kept on local disk when "history_file" is set, see WindowHistory
+    def create_history(self, cfg):
+        if 'history_file' not in cfg:
+            return None
+        return WindowHistory(cfg['history_file'], cfg.get('history_size', 8*1024*1024),
+                             cfg.get('history_backups', 3))
+
+
+    # published vs suppressed counts from the deadband filter
+    def publish_stats(self):
+        return self._mappings.deadband.stats()
+
+
+    # copy counts kept on the hot path into the metrics registry, called when scraped
+    def collect_metrics(self):
+        ADVERTISEMENTS.set(self._advertisements)
+        unknown = self._unknown.counts()
+        for beacon, n in unknown['beacons'].items():
+            UNKNOWN.set(n, (beacon,))
+        UNTRACKED.set(unknown['untracked'])
+        FILTERED.set(self._filtered)
+        WINDOW_OVERRUNS.set(self._scheduler.stats()['overruns'])
+        SUPPRESSED.set(self._mappings.deadband.stats()['suppressed'])
+
+
+    # frames from instances that aren't mapped are rejected first, without taking the lock
     def beacon_callback(self, bt_addr, rssi, packet, add_info):
+        self._advertisements += 1
         key = add_info['instance']
-        if key in self._sensor_ids:
-            self._beacons.update_beacon(self._sensor_lut[key]['path'], rssi)
+        if key not in self._allowed:
+            self._filtered += 1
+            if self._track_unknown:
+                self._unknown.record(key)
+            return
+        with self._swap_lock:
+            slot = self._slots.get(key)
+            if slot is not None:
+                self._front.update_beacon(slot, rssi)
+
+
+    # advertisements accepted and rejected by the namespace and instance filters
+    def filter_stats(self):
+        return {"namespaces": self._mappings.namespaces,
+                "allowed": len(self._allowed),
+                "advertisements": self._advertisements,
+                "filtered": self._filtered}
+
+
+    # start a new window in the back buffer and return the buffer holding the closed one
+    def swap_buffers(self):
+        back = self._back
+        back.reset_all_beacons()
+        with self._swap_lock:
+            back.carry_from(self._front)
+            closed = self._front
+            self._front = back
+        self._back = closed
+        return closed
+
+
+    # start a new window with new mappings and return the buffer holding the closed one;
+    # sensors mapped as before keep their estimator state
+    def swap_mappings(self, mappings, buffers):
+        front, back = buffers
+        unchanged = mappings.unchanged(self._mappings)
+        with self._swap_lock:
+            closed = self._front
+            front.carry_from(closed, unchanged)
+            self._mappings = mappings
+            self._slots = mappings.slots
+            self._allowed = mappings.allowed
+            self._front = front
+        self._back = back
+        return closed
+
+
+    # apply the rest of a new configuration once its mappings are in place, previous
+    # being the mappings the last window was published with
+    def apply_pending(self, cfg, mappings, previous):
+        old = self._cfg
+        self._cfg = cfg
+        self._name = cfg['name']
+        self._scheduler.set_period(float(cfg['frequency'])/1000)
+        self._track_unknown = cfg.get('track_unknown', True)
+        mappings.deadband.carry(previous.deadband, mappings.unchanged(previous))
+
+        # paths no longer mapped are reported NOT_RUNNING and their publishers closed
+        removed = set(previous.paths) - set(mappings.paths)
+        keys = ['name', 'mqtt', 'batch', 'batch_path', 'shared_mqtt', 'spool_file', 'spool_size']
+        if any(old.get(k) != cfg.get(k) for k in keys):
+            self._publishers.remove_pubs(removed)
+            self._publishers.close()
+            self._publishers = self.create_publishers(cfg, mappings.paths)
+            self._publishers.publish_status_all("RUNNING")
         else:
-            if key not in self._logged_missing_ids:
-                self._logged_missing_ids.append(key)
-                logger.warning("[%s]: Encountered unknown beacon %s", datetime.now(), key)
+            self._publishers.remove_pubs(removed)
+            added = [ p for p in set(mappings.paths) if not self._publishers.has_path(p) ]
+            self._publishers.create_pubs(cfg['mqtt'], added)
+            for p in added:
+                self._publishers.publish_status(p, "RUNNING")
+
+        keys = ['history_file', 'history_size', 'history_backups']
+        if any(old.get(k) != cfg.get(k) for k in keys):
+            if self._history is not None:
+                self._history.close()
+            self._history = self.create_history(cfg)
+
+        if old['namespace'] != cfg['namespace']:
+            logger.info("[%s] namespace changed, restarting scanner", str(datetime.now()))
+            self._scanner.stop()
+            self._scanner = self.create_scanner()
+            self._scanner.start()
+        logger.info("[%s] new configuration applied, %d mappings", str(datetime.now()), len(mappings.ids))
+
+
+    # window scheduling jitter and the time taken to publish the last window
+    def window_stats(self):
+        stats = self._scheduler.stats()
+        stats['publish_ms'] = self._publish_time * 1000
+        return stats
         
 
     def stop(self):
@@ -77,6 +248,43 @@ class BeaconScanAndPublish(Thread):
         if self._publishers is not None:
             self._publishers.publish_status_all("NOT_RUNNING")
 
+
+    # beacontools (and its Bluetooth dependencies) are only imported when scanning starts
+    def create_scanner(self):
+        from beacontools import BeaconScanner, EddystoneFilter
+        return BeaconScanner(self.beacon_callback,
+                             device_filter=[ EddystoneFilter(namespace=ns) for ns in self._mappings.namespaces ])
+
+
+    # publish the values of a closed window collected with mappings
+    def publish_closed(self, closed, mappings):
+        window = []
+        for slot, x in enumerate(mappings.ids):
+            b = closed.get_beacon(slot)
+            SAMPLES.set(b['count'], (x,))
+            mode = mappings.modes[slot]
+            if b[mode] is not None and mappings.deadband.should_publish(slot, b[mode]):
+                path = mappings.lut[x]['path']
+                field = mappings.lut[x]['field']
+                logger.debug("[%s] %f on %d samples", path + ":" + field, b[mode], b['count'])
+                window.append((x, path, field, b[mode]))
+        self._publishers.publish_window(window)
+
+
+    # append the aggregates of every beacon seen in a closed window to the history
+    def record_history(self, timestamp, closed, mappings):
+        rows = []
+        for slot, x in enumerate(mappings.ids):
+            b = closed.get_beacon(slot)
+            if b['count']:
+                rows.append((mappings.lut[x]['path'], mappings.lut[x]['field'], b['count'],
+                             b['min'], b['max'], b['mean'], b['last']))
+        if rows:
+            try:
+                self._history.append(timestamp, rows)
+            except (IOError, OSError, struct.error, ValueError) as e:
+                logger.error("[%s] failed to write history: %s", str(datetime.now()), e)
+
         
     def run(self):
         if self._cfg is None:
@@ -84,86 +292,323 @@ class BeaconScanAndPublish(Thread):
             return
         
         if self._scanner is None:
-            self._scanner = BeaconScanner(self.beacon_callback,
-                                          device_filter=EddystoneFilter(namespace=self._cfg['namespace']))
+            self._scanner = self.create_scanner()
         self._scanner.start()
         self._running = True
         self._publishers.publish_status_all("RUNNING")
         logger.info("[%s] starting scanner", str(datetime.now()))
-        while not self._stop_event.is_set():
-            self._beacons.reset_all_beacons(self._sensor_paths)
-            time.sleep(float(self._cfg['frequency'])/1000)
+        self._front.reset_all_beacons()
+        self._scheduler.start()
+        while self._scheduler.wait(self._stop_event):
+            with self._pending_lock:
+                pending = self._pending
+                self._pending = None
+            mappings = self._mappings
+            if pending is None:
+                closed = self.swap_buffers()
+            else:
+                closed = self.swap_mappings(pending[1], pending[2])
+            start = monotonic()
             logger.debug("[%s] scan data collected", str(datetime.now()))
-            for x in self._sensor_ids:
-                b = self._beacons.get_beacon(self._sensor_lut[x]['path'])
-                if b[self._cfg['mode']] is not None:
-                    path = self._sensor_lut[x]['path']
-                    field = self._sensor_lut[x]['field']
-                    logger.debug("[%s] %f on %d samples", path + ":" + field, b[self._cfg['mode']], b['count'])
-                    self._publishers.publish_beacon(x, path, field, b[self._cfg['mode']])
+            self.publish_closed(closed, mappings)
+            if self._history is not None:
+                self.record_history(time.time(), closed, mappings)
+            if pending is not None:
+                self.apply_pending(pending[0], pending[1], mappings)
+            self._publish_time = monotonic() - start
+            WINDOW_TIME.observe(self._publish_time)
+            logger.debug("[%s] window published in %.1fms, jitter %.1fms", str(datetime.now()),
+                         self._publish_time * 1000, self._scheduler.stats()['last_jitter_ms'])
         logger.info("[%s] Stop Event received - shutting down publisher", str(datetime.now()))
         self._scanner.stop()
         self._scanner = None
         self._running = False
         
 
+
+class SensorMappings:
+    # build the per sensor lookups from the "mappings" in the beacons configuration
+    def __init__(self, cfg):
+        self._cfg = cfg
+
+        # lut maps UID of the sensor to the path, field name and aggregation mode
+        # a mapping's "mode" overrides the top level one
+        self.lut = {}
+        for m in cfg['mappings']:
+            mode = m.get('mode', cfg['mode'])
+            if not valid_mode(mode):
+                raise ValueError("unrecognized mode: {0}".format(mode))
+            self.lut[m['sensor']] = {'path': m['path'], 'field': m['field'], 'mode': mode, 'options': m}
+
+        # list of all the sensor UIDs and paths, the position in the list is the sensor's slot
+        self.ids = self.lut.keys()
+        self.paths = [ self.lut[x]['path'] for x in self.ids ]
+        self.slots = dict((x, i) for i, x in enumerate(self.ids))
+        self.modes = [ self.lut[x]['mode'] for x in self.ids ]
+
+        # "namespace" is one Eddystone namespace or a list of them; only frames from the
+        # mapped instances in those namespaces reach the window buffers
+        ns = cfg['namespace']
+        self.namespaces = [ns] if isinstance(ns, basestring) else list(ns)
+        self.allowed = frozenset(self.ids)
+
+        # "deadband" (absolute) and "deadband_relative" (fraction of the last value sent)
+        # suppress values that barely moved, "heartbeat" forces a publish after that many
+        # suppressed windows (0 suppresses none); all three can be set at the top level or
+        # per mapping
+        self.deadband = Deadband([ self.option(x, 'deadband') for x in self.ids ],
+                                 [ self.option(x, 'deadband_relative') for x in self.ids ],
+                                 [ self.option(x, 'heartbeat', 10) for x in self.ids ])
+
+
+    # option for a sensor's mapping, falling back to the top level configuration
+    def option(self, sensor, name, default=None):
+        return self.lut[sensor]['options'].get(name, self._cfg.get(name, default))
+
+
+    # (slot, slot in other) for every sensor mapped exactly as in other, whose
+    # deadband and estimator state can carry over to these mappings
+    def unchanged(self, other):
+        keys = ['deadband', 'deadband_relative', 'heartbeat']
+        return [ (i, other.slots[x]) for i, x in enumerate(self.ids)
+                 if x in other.lut and self.lut[x] == other.lut[x]
+                 and all(self.option(x, k) == other.option(x, k) for k in keys) ]
+
+
+    def create_buffer(self):
+        return BeaconData(len(self.ids), self.modes,
+                          [ create_estimator(self.lut[x]['mode'], self.lut[x]['options']) for x in self.ids ])
+
+
+
 class BeaconData:
-    def __init__(self):
-        self._data = {}
+    # slots is the number of sensors, each sensor is addressed by its slot index
+    # modes and estimators give the mode and StreamingStats estimator (or None) per slot
+    def __init__(self, slots, modes=None, estimators=None):
+        self._slots = slots
+        self._modes = modes if modes is not None else [None] * slots
+        self._estimators = estimators if estimators is not None else [None] * slots
+        self._streaming = [ e for e in self._estimators if e is not None ]
+        self._zero_count = array('l', [0] * slots)
+        self._zero_value = array('d', [0.0] * slots)
+        self._count = array('l', self._zero_count)
+        self._total = array('d', self._zero_value)
+        self._min = array('d', self._zero_value)
+        self._max = array('d', self._zero_value)
+        self._last = array('d', self._zero_value)
         
 
-    # reset sensor data for all sensors beacons named in the list
-    def reset_all_beacons(self, sensor_list):
-        map(lambda s: self.reset_beacon(s), sensor_list)
+    # reset sensor data for all sensors, zeroing the buffers in place
+    def reset_all_beacons(self):
+        self._count[:] = self._zero_count
+        self._total[:] = self._zero_value
+        for e in self._streaming:
+            e.reset()
             
 
     # reset the sensor data for a single beacon
-    def reset_beacon(self, s):
-        self._data[s] = { 'count': 0,
-                          'total': 0,
-                          'min': None,
-                          'max': None,
-                          'last': None,
-                          'time': None,
-                          'mean': None }
+    def reset_beacon(self, slot):
+        self._count[slot] = 0
+        self._total[slot] = 0.0
+        if self._estimators[slot] is not None:
+            self._estimators[slot].reset()
+
+
+    # carry estimator state that spans windows (eg: EWMA) over from another buffer,
+    # slot for slot or for the (slot, slot in other) pairs given
+    def carry_from(self, other, slots=None):
+        if slots is None:
+            slots = enumerate(range(self._slots))
+        for slot, o in slots:
+            e = self._estimators[slot]
+            if e is not None and other._estimators[o] is not None:
+                e.carry(other._estimators[o])
         
     # update the data for a specific beacon
-    def update_beacon(self, s, rssi):
-        if s not in self._data.keys():
-            logger.warning("[%s] unrecognized sensor %s", str(datetime.now()), s)
-        else:
-            d = self.get_beacon(s)
-            d['count'] += 1
-            d['total'] += rssi
-            d['last'] = rssi
-            d['mean'] = float(d['total']) / d['count']
-            if d['min'] is None or rssi < d['min']:
-                d['min'] = rssi
-            if d['max'] is None or rssi > d['max']:
-                d['max'] = rssi
+    def update_beacon(self, slot, rssi):
+        n = self._count[slot]
+        self._count[slot] = n + 1
+        self._total[slot] += rssi
+        self._last[slot] = rssi
+        if n == 0 or rssi < self._min[slot]:
+            self._min[slot] = rssi
+        if n == 0 or rssi > self._max[slot]:
+            self._max[slot] = rssi
+        e = self._estimators[slot]
+        if e is not None:
+            e.add(rssi)
             
 
-    # return the data object for a single beacon
-    def get_beacon(self, s):
-        return self._data[s]
+    # return the data for a single beacon, values are None if there were no samples
+    def get_beacon(self, slot):
+        n = self._count[slot]
+        if n == 0:
+            d = { 'count': 0, 'total': 0, 'min': None, 'max': None,
+                  'last': None, 'time': None, 'mean': None }
+            if self._modes[slot] is not None:
+                d[self._modes[slot]] = None
+            return d
+        d = { 'count': n,
+              'total': self._total[slot],
+              'min': self._min[slot],
+              'max': self._max[slot],
+              'last': self._last[slot],
+              'time': None,
+              'mean': self._total[slot] / n }
+        if self._estimators[slot] is not None:
+            d[self._modes[slot]] = self._estimators[slot].value()
+        return d
+
+
+
+class UnknownBeacons:
+    # keeps advertisement counts for at most max_ids unknown beacons
+    def __init__(self, max_ids=256):
+        self._max_ids = max_ids
+        self._counts = {}
+        self._overflow = 0
+
+
+    # count an advertisement from an unmapped beacon, logging the first one seen
+    def record(self, key):
+        n = self._counts.get(key)
+        if n is not None:
+            self._counts[key] = n + 1
+        elif len(self._counts) < self._max_ids:
+            self._counts[key] = 1
+            logger.warning("[%s]: Encountered unknown beacon %s", datetime.now(), key)
+        else:
+            self._overflow += 1
+
+
+    # advertisement counts per unknown beacon, plus those beyond the tracked set
+    def counts(self):
+        return {"beacons": dict(self._counts), "untracked": self._overflow}
+
+
+
+class Deadband:
+    # per slot absolute and relative thresholds (None for no deadband) and heartbeat windows:
+    # with a heartbeat of N, N quiet windows are suppressed and the next one is published
+    def __init__(self, absolute, relative, heartbeat):
+        self._absolute = absolute
+        self._relative = relative
+        self._heartbeat = [ int(h) for h in heartbeat ]
+        self._last = [None] * len(absolute)
+        self._quiet = [0] * len(absolute)
+        self._sent = 0
+        self._suppressed = 0
+        self._heartbeats = 0
+
+
+    # True if value should be published for slot, counting the decision
+    def should_publish(self, slot, value):
+        last = self._last[slot]
+        a = self._absolute[slot]
+        r = self._relative[slot]
+        if last is not None and (a is not None or r is not None):
+            delta = abs(value - last)
+            if not ((a is not None and delta > a) or (r is not None and delta > r * abs(last))):
+                self._quiet[slot] += 1
+                if self._quiet[slot] <= self._heartbeat[slot]:
+                    self._suppressed += 1
+                    return False
+                self._heartbeats += 1
+        self._last[slot] = value
+        self._quiet[slot] = 0
+        self._sent += 1
+        return True
+
+
+    # continue from the last values sent by another Deadband for the (slot, slot in
+    # other) pairs given, and from its counts
+    def carry(self, other, slots):
+        for slot, o in slots:
+            self._last[slot] = other._last[o]
+            self._quiet[slot] = other._quiet[o]
+        self._sent = other._sent
+        self._suppressed = other._suppressed
+        self._heartbeats = other._heartbeats
+
+
+    def stats(self):
+        return {"sent": self._sent,
+                "suppressed": self._suppressed,
+                "heartbeats": self._heartbeats}
 
 
 
 class BeaconPublisher(Thread):
-    def __init__(self, name):
+    # batch is None to publish each beacon on its own, "path" to send one message per
+    # path, or "receiver" to send one message per window to batch_path
+    # shared multiplexes every path over the process-wide broker connection
+    def __init__(self, name, batch=None, batch_path=None, shared=False):
         Thread.__init__(self)
         self._name = name
+        self._batch = batch
+        self._batch_path = batch_path
+        self._shared = shared
         self._pubs = {}
+        self._mqttaddr = None
+        self._spool = None
+        self._replay = None
 
 
     # create publication objects for a list of paths
     # path_list is an array of SA paths
     def create_pubs(self, mqttaddr, path_list):
-        if mqttaddr.startswith("tcp://"):
-            mqttaddr = mqttaddr[6:]
-        addr, port = mqttaddr.split(":")
+        self._mqttaddr = mqttaddr
+        if self._batch == 'receiver':
+            path_list = path_list + [self._batch_path]
+        for p in path_list:
+            if p not in self._pubs:
+                self._pubs[p] = create_publisher(mqttaddr, p, self._shared)
+
+
+    def has_path(self, path):
+        return path in self._pubs
+
+
+    # publish NOT_RUNNING to paths that are no longer mapped and close their publishers
+    def remove_pubs(self, path_list):
         for p in path_list:
-            self._pubs[p] = sdw.MQTT(addr, int(port), p)
+            if p in self._pubs and not (self._batch == 'receiver' and p == self._batch_path):
+                self.publish_status(p, "NOT_RUNNING")
+                close_publisher(self._pubs.pop(p))
+
+
+    # close the publishers of every path, eg: when they are replaced by new ones
+    def close(self):
+        for pub in self._pubs.values():
+            close_publisher(pub)
+        self._pubs = {}
+
+
+    # keep failed publications in spool, replayed by replay when the broker is reachable
+    def set_spool(self, spool, replay):
+        self._spool = spool
+        self._replay = replay
+
+
+    # spool the values of a failed publication, or kick the replay after a successful one
+    def handle_result(self, success, path, payloads):
+        if self._spool is None:
+            return
+        if success:
+            self._replay.kick()
+        else:
+            self._spool.append(self._mqttaddr, path,
+                               {"datetime": datetime.utcnow().isoformat() + "Z", "values": payloads})
+
+
+    # publish values to a path, recording the latency and any failure
+    def publish_values(self, path, payloads):
+        start = monotonic()
+        success = self._pubs[path].publish_values(payloads)
+        PUBLISH_LATENCY.observe(monotonic() - start, (path,))
+        if not success:
+            PUBLISH_FAILURES.inc(1, (path,))
+        return success
 
 
     # publish status to a sensor, adding the receiver name as an attribute
@@ -182,13 +627,48 @@ class BeaconPublisher(Thread):
         logger.debug("[%s] status publication result: %s", str(datetime.now()), str(s))
 
 
+    # create a value payload for a beacon's RSSI, with the receiver and beacon as attributes
+    def create_beacon_value(self, pub, uid, field, value):
+        payload = pub.create_value(field, float(value))
+        payload['attributes']['receiver'] = self._name
+        payload['attributes']['beacon'] = uid
+        return payload
+
+
+    # publish the values of one window, a list of (uid, path, field, value)
+    def publish_window(self, values):
+        if self._batch is None:
+            for uid, path, field, value in values:
+                self.publish_beacon(uid, path, field, value)
+            return
+
+        batches = {}
+        for uid, path, field, value in values:
+            target = path if self._batch == 'path' else self._batch_path
+            try:
+                payload = self.create_beacon_value(self._pubs[target], uid, field, value)
+            except ValueError:
+                logger.error("[%s] value error on %s sending to %s:%s", str(datetime.now()), value, path, field)
+                continue
+            if self._batch == 'receiver':
+                payload['attributes']['path'] = path
+            batches.setdefault(target, []).append(payload)
+
+        for target, payloads in batches.items():
+            success = self.publish_values(target, payloads)
+            self.handle_result(success, target, payloads)
+            if not success:
+                logger.error("[%s] error publishing %d values on %s", str(datetime.now()), len(payloads), target)
+            else:
+                logger.debug("[%s] published %d values to %s", str(datetime.now()), len(payloads), target)
+
+
     # publish a beacon's RSSI
     def publish_beacon(self, uid, path, field, value):
         try:
-            payload = self._pubs[path].create_value(field, float(value))
-            payload['attributes']['receiver'] = self._name
-            payload['attributes']['beacon'] = uid
-            success = self._pubs[path].publish_values([payload])
+            payload = self.create_beacon_value(self._pubs[path], uid, field, value)
+            success = self.publish_values(path, [payload])
+            self.handle_result(success, path, [payload])
             if not success:
                 logger.error("[%s] error publishing %f on %s:%s", str(datetime.now()), float(value), path, field)
             else:
@@ -0,0 +1,96 @@
+import json
+import socket
+import httplib
+import logging
+import urllib2
+from threading import Thread, Event
+from datetime import datetime
+
+
+logger = logging.getLogger(__name__)
+
+
+'''
+
+Background check-in of the receiver with its controller
+
+CheckIn posts the receiver's name, controller, interface and address to the
+controller from its own thread, so a controller that is down or slow never holds up
+bt-manager. Each attempt has a timeout. Failures are retried with exponential
+backoff (retry doubling up to max_retry seconds), and once checked in the receiver
+checks in again every heartbeat seconds, which also picks up a changed address.
+
+netifaces is only imported by the check-in thread.
+
+'''
+
+
+class CheckIn(Thread):
+    def __init__(self, cfg, timeout=5, heartbeat=300, retry=5, max_retry=300):
+        Thread.__init__(self)
+        self.daemon = True
+        self._cfg = cfg
+        self._timeout = float(timeout)
+        self._heartbeat = float(heartbeat)
+        self._retry = float(retry)
+        self._max_retry = float(max_retry)
+        self._stop_event = Event()
+        self._attempts = 0
+        self._failures = 0
+        self._last_success = None
+        self._last_error = None
+
+
+    def stats(self):
+        return {"attempts": self._attempts,
+                "failures": self._failures,
+                "last_success": self._last_success,
+                "last_error": self._last_error}
+
+
+    def stop(self):
+        self._stop_event.set()
+
+
+    def run(self):
+        delay = self._retry
+        while not self._stop_event.is_set():
+            try:
+                accepted = self.check_in()
+            except Exception as e:
+                # an unexpected failure must not end the heartbeat, count it and retry
+                self._failures += 1
+                self._last_error = "[{0}] {1}".format(str(datetime.now()), e)
+                logger.exception("[%s] check-in failed unexpectedly", str(datetime.now()))
+                accepted = False
+            if accepted:
+                delay = self._retry
+                wait = self._heartbeat
+            else:
+                wait = delay
+                delay = min(delay * 2, self._max_retry)
+            self._stop_event.wait(wait)
+
+
+    # one check-in attempt, True if the controller accepted it
+    def check_in(self):
+        self._attempts += 1
+        try:
+            info = {"name": self._cfg["name"], "controller": self._cfg["controller"],
+                    "address": self.address(), "interface": self._cfg["interface"]}
+            r = urllib2.urlopen(self._cfg["controller"], data="json="+json.dumps(info), timeout=self._timeout)
+            logger.info("[%s] result from check-in: %s", str(datetime.now()), r.read())
+            self._last_success = str(datetime.now())
+            return True
+        except (IOError, socket.error, httplib.HTTPException, ValueError, KeyError, ImportError) as e:
+            self._failures += 1
+            self._last_error = "[{0}] {1}".format(str(datetime.now()), e)
+            logger.warning("[%s] check-in failed: %s", str(datetime.now()), e)
+            return False
+
+
+    def address(self):
+        import netifaces as ni
+        if self._cfg["interface"] not in ni.interfaces():
+            raise ValueError("interface {0} doesn't exist".format(self._cfg["interface"]))
+        return ni.ifaddresses(self._cfg["interface"])[ni.AF_INET][0]['addr']
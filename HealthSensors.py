@@ -0,0 +1,144 @@
+import os
+import logging
+from datetime import datetime
+
+
+logger = logging.getLogger(__name__)
+
+
+'''
+
+Health readings for the receiver, published by TemperatureScan
+
+SysfsSensors     - reads sysfs/procfs files through handles kept open between reads
+VcgencmdSensors  - the original backend, runs "vcgencmd measure_temp" for every reading
+
+create_sensors() builds the backend named by the "backend" item (default sysfs).
+read() returns a list of (field, value) for every reading that could be taken this
+cycle, so they go out in one publish_values call. The sysfs readings are:
+
+  "cpu_temp"      - SoC temperature in C, from thermal_zone0, published with "field"
+  "load"          - 1 minute load average, from /proc/loadavg
+  "mem_available" - available memory in MB, from /proc/meminfo
+  "throttled"     - firmware throttling flags, on Raspberry Pi kernels that export them
+
+"sysfs_root" prefixes every path (default /) so a fake tree can stand in for /sys and
+/proc. The sources are opened when the sensors are created, and readings whose source
+doesn't exist are skipped, with one warning naming them.
+
+'''
+
+READINGS = ['cpu_temp', 'load', 'mem_available', 'throttled']
+
+_SOURCES = {'cpu_temp': ['sys/class/thermal/thermal_zone0/temp'],
+            'load': ['proc/loadavg'],
+            'mem_available': ['proc/meminfo'],
+            'throttled': ['sys/devices/platform/soc/soc:firmware/get_throttled']}
+
+
+class SysfsSensors:
+    def __init__(self, field, readings=None, root='/'):
+        self._field = field
+        self._readings = READINGS if readings is None else readings
+        self._root = root
+        self._files = {}
+        for r in self._readings:
+            if r not in _SOURCES:
+                raise ValueError("unrecognized reading: {0}".format(r))
+        for r in self._readings:
+            self._files[r] = self._open(r)
+        if self.missing():
+            logger.warning("[%s] no source under %s for %s, skipping them", str(datetime.now()), root,
+                           ", ".join(self.missing()))
+
+
+    def read(self):
+        values = []
+        for r in self._readings:
+            text = self._read_source(r)
+            if text is None:
+                continue
+            try:
+                values.append(getattr(self, '_parse_' + r)(text))
+            except (ValueError, IndexError) as e:
+                logger.warning("[%s] bad %s reading %r: %s", str(datetime.now()), r, text, e)
+        return values
+
+
+    # readings whose source doesn't exist
+    def missing(self):
+        return [ r for r in self._readings if self._files.get(r) is None ]
+
+
+    def close(self):
+        for fp in self._files.values():
+            if fp is not None:
+                fp.close()
+        self._files = {}
+
+
+    # contents of the reading's source file, read again from the start of the open handle
+    def _read_source(self, reading):
+        fp = self._files.get(reading)
+        if fp is None:
+            return None
+        try:
+            fp.seek(0)
+            return fp.read()
+        except (IOError, ValueError) as e:
+            logger.warning("[%s] failed to read %s: %s", str(datetime.now()), fp.name, e)
+            return None
+
+
+    # the first source of the reading that exists, None if there isn't one
+    def _open(self, reading):
+        for path in _SOURCES[reading]:
+            try:
+                return open(os.path.join(self._root, path), 'r', 0)
+            except IOError:
+                pass
+        return None
+
+
+    def _parse_cpu_temp(self, text):
+        return (self._field, int(text) / 1000.0)
+
+
+    def _parse_load(self, text):
+        return ('load', float(text.split()[0]))
+
+
+    def _parse_mem_available(self, text):
+        for line in text.splitlines():
+            if line.startswith('MemAvailable:'):
+                return ('mem_available', int(line.split()[1]) / 1024.0)
+        raise ValueError("no MemAvailable")
+
+
+    def _parse_throttled(self, text):
+        return ('throttled', int(text.strip(), 16))
+
+
+
+class VcgencmdSensors:
+    def __init__(self, field):
+        self._field = field
+
+
+    def read(self):
+        temp = os.popen("vcgencmd measure_temp").readline()
+        return [ (self._field, float(temp.replace("temp=","").replace("'C",""))) ]
+
+
+    def close(self):
+        pass
+
+
+
+def create_sensors(cfg):
+    backend = cfg.get('backend', 'sysfs')
+    if backend == 'sysfs':
+        return SysfsSensors(cfg['field'], cfg.get('readings'), cfg.get('sysfs_root', '/'))
+    if backend == 'vcgencmd':
+        return VcgencmdSensors(cfg['field'])
+    raise ValueError("unrecognized sensor backend: {0}".format(backend))
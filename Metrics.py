@@ -0,0 +1,138 @@
+from bisect import bisect_left
+
+
+'''
+
+Minimal metrics registry rendered in the Prometheus text exposition format
+
+Counter   - monotonically increasing value
+Gauge     - value that can go up and down
+Histogram - observations counted into cumulative buckets, with their sum and count
+
+Every metric takes optional label names and keeps one value per tuple of label values.
+Updating a metric is a dict lookup and an add, cheap enough for the beacon callback.
+registry is the process-wide registry served by bt-manager's /metrics route.
+
+'''
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+
+
+    def inc(self, amount=1, labels=()):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+    # set the total directly, for counts kept elsewhere and copied in when scraped
+    def set(self, value, labels=()):
+        self._values[labels] = value
+
+
+    def samples(self):
+        return [ (self.name, labels, value) for labels, value in self._values.items() ]
+
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._buckets = tuple(buckets)
+        self._values = {}
+
+
+    def observe(self, value, labels=()):
+        h = self._values.get(labels)
+        if h is None:
+            h = [[0] * (len(self._buckets) + 1), 0.0, 0]
+            self._values[labels] = h
+        h[0][bisect_left(self._buckets, value)] += 1
+        h[1] += value
+        h[2] += 1
+
+
+    def samples(self):
+        s = []
+        for labels, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, n in zip(self._buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                s.append((self.name + "_bucket", labels + (le,), cumulative))
+            s.append((self.name + "_sum", labels, total))
+            s.append((self.name + "_count", labels, count))
+        return s
+
+
+    def label_names(self, sample_name):
+        return self.labels + ("le",) if sample_name.endswith("_bucket") else self.labels
+
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Gauge(name, help, labels))
+
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+
+    # all metrics in the Prometheus text format
+    def render(self):
+        lines = []
+        for m in self._metrics:
+            lines.append("# HELP {0} {1}".format(m.name, m.help))
+            lines.append("# TYPE {0} {1}".format(m.name, m.kind))
+            for name, values, value in m.samples():
+                names = m.label_names(name) if hasattr(m, 'label_names') else m.labels
+                lines.append("{0}{1} {2}".format(name, _format_labels(names, values), _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = [ '{0}="{1}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+              for n, v in zip(names, values) ]
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+registry = Registry()
@@ -0,0 +1,178 @@
+import json
+import socket
+import logging
+import paho.mqtt.client as mqtt
+from threading import Thread, Event, Lock
+from datetime import datetime
+
+
+logger = logging.getLogger(__name__)
+
+
+'''
+
+Process-wide pool of MQTT broker connections shared by all publishers
+
+BrokerConnection  - one paho connection to a broker, reconnected in the background
+PathPublisher     - publish handle for one SA path, multiplexed over a BrokerConnection
+ConnectionManager - creates and keeps one BrokerConnection per broker address
+
+PathPublisher offers the part of the sdw.MQTT interface used by the publishers here
+(create_value, create_status_payload, publish, publish_values, publish_status) and
+publishes the same messages: values to sdw<path>/value as {"datetime", "values"} and
+status to sdw<path>/status. tests/test_mqtt_connections.py compares its messages with
+sdw.MQTT's.
+
+create_publisher() returns a dedicated sdw.MQTT object, or a PathPublisher on the
+shared connection when shared is True ("shared_mqtt" in the configuration). sdw is
+only imported for the dedicated connections.
+
+'''
+
+
+class BrokerConnection:
+    def __init__(self, addr, port, keepalive=60, max_delay=60):
+        self._addr = addr
+        self._port = port
+        self._max_delay = max_delay
+        self._connected = False
+        self._closed = Event()
+        self._client = mqtt.Client()
+        self._client.on_connect = self.on_connect
+        self._client.on_disconnect = self.on_disconnect
+        self._client.reconnect_delay_set(1, max_delay)
+        self._client.connect_async(addr, port, keepalive)
+        self._thread = Thread(target=self._loop, name="mqtt-{0}:{1}".format(addr, port))
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    # network loop, retrying with backoff when the broker can't be reached
+    def _loop(self):
+        delay = 1
+        while not self._closed.is_set():
+            try:
+                self._client.loop_forever(retry_first_connection=True)
+                delay = 1
+            except (socket.error, IOError) as e:
+                logger.warning("[%s] broker %s:%d unreachable, retrying in %ds: %s",
+                               str(datetime.now()), self._addr, self._port, delay, e)
+                self._closed.wait(delay)
+                delay = min(delay * 2, self._max_delay)
+
+
+    def on_connect(self, client, userdata, flags, rc):
+        self._connected = rc == 0
+        logger.info("[%s] connected to broker %s:%d with result code %d", str(datetime.now()), self._addr, self._port, rc)
+
+
+    def on_disconnect(self, client, userdata, rc):
+        self._connected = False
+        logger.warning("[%s] disconnected from broker %s:%d with result code %d", str(datetime.now()), self._addr, self._port, rc)
+
+
+    def is_connected(self):
+        return self._connected
+
+
+    # publish a JSON payload, returns False if it couldn't be handed to the broker
+    def publish(self, topic, payload):
+        info = self._client.publish(topic, json.dumps(payload))
+        return info.rc == mqtt.MQTT_ERR_SUCCESS
+
+
+    def close(self):
+        self._closed.set()
+        self._client.disconnect()
+        self._thread.join(5)
+
+
+
+class PathPublisher:
+    def __init__(self, connection, path):
+        self._conn = connection
+        self._path = path
+        self._topic = "sdw" + ("" if path.startswith("/") else "/") + path + "/"
+
+
+    def create_value(self, field, value):
+        return {"field": field, "amount": value, "attributes": {}}
+
+
+    def create_status_payload(self, status, message):
+        return {"status": status, "message": message}
+
+
+    def publish(self, subtopic, payload):
+        return self._conn.publish(self._topic + subtopic, payload)
+
+
+    def publish_values(self, values):
+        return self.publish("value", {"datetime": datetime.utcnow().isoformat() + "Z", "values": values})
+
+
+    def publish_status(self, status):
+        return self.publish("status", self.create_status_payload(status, ""))
+
+
+    # the connection is shared with other paths and stays open
+    def close(self):
+        pass
+
+
+
+class ConnectionManager:
+    def __init__(self):
+        self._lock = Lock()
+        self._connections = {}
+
+
+    # return a publish handle for path on the shared connection to mqttaddr (tcp://host:port)
+    def get(self, mqttaddr, path):
+        addr, port = parse_address(mqttaddr)
+        with self._lock:
+            conn = self._connections.get((addr, port))
+            if conn is None:
+                conn = BrokerConnection(addr, port)
+                self._connections[(addr, port)] = conn
+        return PathPublisher(conn, path)
+
+
+    # connection state per broker
+    def status(self):
+        return dict(("{0}:{1}".format(a, p), c.is_connected()) for (a, p), c in self._connections.items())
+
+
+    def close_all(self):
+        with self._lock:
+            for c in self._connections.values():
+                c.close()
+            self._connections = {}
+
+
+
+connections = ConnectionManager()
+
+
+# split tcp://host:port into host and port
+def parse_address(mqttaddr):
+    if mqttaddr.startswith("tcp://"):
+        mqttaddr = mqttaddr[6:]
+    addr, port = mqttaddr.split(":")
+    return addr, int(port)
+
+
+# release a publisher from create_publisher, closing a dedicated sdw.MQTT connection
+def close_publisher(pub):
+    close = getattr(pub, 'close', None) or getattr(pub, 'disconnect', None)
+    if close is not None:
+        close()
+
+
+# create a publisher for an SA path, on the process-wide connection when shared is True
+def create_publisher(mqttaddr, path, shared=False):
+    if shared:
+        return connections.get(mqttaddr, path)
+    import sdw
+    addr, port = parse_address(mqttaddr)
+    return sdw.MQTT(addr, port, path)
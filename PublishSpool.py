@@ -0,0 +1,241 @@
+import os
+import json
+import mmap
+import struct
+import logging
+from threading import Thread, Event, Lock
+from datetime import datetime
+
+
+logger = logging.getLogger(__name__)
+
+
+'''
+
+Store-and-forward spool for publications that failed to reach the broker
+
+PublishSpool - append-only ring of messages in a memory-mapped file with a fixed size
+SpoolReplay  - background thread that republishes spooled messages, oldest first
+
+Each record is a 4 byte length followed by JSON holding the broker address, SA path
+and the complete value message, including the datetime it was created with, so a
+replayed value keeps its original timestamp. The head/tail offsets live in the file
+header, so spooled messages survive a restart. When the ring is full the oldest
+records are dropped to make room. Appending is a memory copy under a lock and never
+waits on the network; all publishing happens on the replay thread.
+
+open_spool() returns the process-wide spool for a file, starting its replay thread.
+
+'''
+
+_MAGIC = 'BTSP'
+_VERSION = 1
+_HEADER = struct.Struct('<4sIQQQ')
+_LENGTH = struct.Struct('<I')
+
+
+class PublishSpool:
+    def __init__(self, filename, size=4*1024*1024):
+        self._filename = filename
+        self._size = int(size)
+        self._capacity = self._size - _HEADER.size
+        self._lock = Lock()
+        self._appended = 0
+        self._dropped = 0
+        self._replayed = 0
+
+        exists = os.path.exists(filename) and os.path.getsize(filename) == self._size
+        self._fp = open(filename, 'r+b' if exists else 'w+b')
+        if not exists:
+            self._fp.truncate(self._size)
+        self._map = mmap.mmap(self._fp.fileno(), self._size)
+
+        magic, version, head, tail, count = _HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC or version != _VERSION or head > self._capacity or tail > self._capacity:
+            head, tail, count = 0, 0, 0
+        # a record ending exactly at the end of the ring leaves the next position at the start
+        head, tail = head % self._capacity, tail % self._capacity
+        self._head, self._tail, self._count = head, tail, count
+        self._write_header()
+        if count:
+            logger.info("[%s] spool %s holds %d messages from a previous run", str(datetime.now()), filename, count)
+
+
+    # add a value message that couldn't be published; never blocks on the network
+    def append(self, mqttaddr, path, message):
+        data = json.dumps({"mqtt": mqttaddr, "path": path, "message": message})
+        n = _LENGTH.size + len(data)
+        if n > self._capacity // 2:
+            logger.error("[%s] message for %s too large to spool (%d bytes)", str(datetime.now()), path, n)
+            return False
+
+        with self._lock:
+            pos = self._find_space(n)
+            while pos is None:
+                self._drop_oldest()
+                pos = self._find_space(n)
+            if pos == 0 and self._tail != 0 and self._capacity - self._tail >= _LENGTH.size:
+                _LENGTH.pack_into(self._map, _HEADER.size + self._tail, 0)
+            _LENGTH.pack_into(self._map, _HEADER.size + pos, len(data))
+            start = _HEADER.size + pos + _LENGTH.size
+            self._map[start:start + len(data)] = data
+            self._tail = (pos + n) % self._capacity
+            self._count += 1
+            self._appended += 1
+            self._write_header()
+        return True
+
+
+    # return (token, record) for the oldest message, or None if the spool is empty
+    def peek(self):
+        with self._lock:
+            if self._count == 0:
+                return None
+            pos, length = self._locate(self._head)
+            start = _HEADER.size + pos + _LENGTH.size
+            return (self._head, self._appended - self._count), json.loads(self._map[start:start + length])
+
+
+    # remove the oldest message if it is still the one returned with token
+    def pop(self, token):
+        with self._lock:
+            if self._count == 0 or token != (self._head, self._appended - self._count):
+                return
+            pos, length = self._locate(self._head)
+            self._advance(pos + _LENGTH.size + length)
+            self._replayed += 1
+            self._write_header()
+
+
+    def pending(self):
+        return self._count
+
+
+    def stats(self):
+        return {"pending": self._count,
+                "spooled": self._appended,
+                "replayed": self._replayed,
+                "dropped": self._dropped}
+
+
+    def close(self):
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+            self._fp.close()
+
+
+    # offset to write n bytes at, or None if the ring doesn't have room
+    def _find_space(self, n):
+        if self._count == 0:
+            self._head = self._tail = 0
+            return 0
+        if self._tail > self._head:
+            if n <= self._capacity - self._tail:
+                return self._tail
+            if n <= self._head:
+                return 0
+            return None
+        if self._tail < self._head and n <= self._head - self._tail:
+            return self._tail
+        return None
+
+
+    # position and length of the record at pos, following a wrap to the start
+    def _locate(self, pos):
+        if self._capacity - pos < _LENGTH.size:
+            pos = 0
+        length = _LENGTH.unpack_from(self._map, _HEADER.size + pos)[0]
+        if length == 0:
+            pos = 0
+            length = _LENGTH.unpack_from(self._map, _HEADER.size)[0]
+        return pos, length
+
+
+    def _advance(self, head):
+        self._head = head % self._capacity
+        self._count -= 1
+        if self._count == 0:
+            self._head = self._tail = 0
+
+
+    def _drop_oldest(self):
+        pos, length = self._locate(self._head)
+        self._advance(pos + _LENGTH.size + length)
+        self._dropped += 1
+        if self._dropped % 100 == 1:
+            logger.warning("[%s] spool full, %d messages dropped so far", str(datetime.now()), self._dropped)
+
+
+    def _write_header(self):
+        _HEADER.pack_into(self._map, 0, _MAGIC, _VERSION, self._head, self._tail, self._count)
+
+
+
+class SpoolReplay(Thread):
+    def __init__(self, spool, interval=5, batch=100, shared=False):
+        Thread.__init__(self)
+        self.daemon = True
+        self._spool = spool
+        self._interval = float(interval)
+        self._batch = int(batch)
+        self._shared = shared
+        self._pubs = {}
+        self._wake = Event()
+
+
+    # ask for a replay attempt now, eg: after a live publish succeeded
+    def kick(self):
+        if self._spool.pending():
+            self._wake.set()
+
+
+    def run(self):
+        while True:
+            self._wake.wait(self._interval)
+            self._wake.clear()
+            replayed = 0
+            while replayed < self._batch:
+                item = self._spool.peek()
+                if item is None or not self._publish(item[1]):
+                    break
+                self._spool.pop(item[0])
+                replayed += 1
+            if replayed:
+                logger.info("[%s] replayed %d spooled messages, %d pending", str(datetime.now()),
+                            replayed, self._spool.pending())
+                if self._spool.pending():
+                    self._wake.set()
+
+
+    # MqttConnections (and sdw) are only imported once there is something to replay
+    def _publish(self, record):
+        from MqttConnections import create_publisher
+        key = (record['mqtt'], record['path'])
+        pub = self._pubs.get(key)
+        if pub is None:
+            pub = create_publisher(record['mqtt'], record['path'], self._shared)
+            self._pubs[key] = pub
+        try:
+            return pub.publish("value", record['message'])
+        except Exception as e:
+            logger.warning("[%s] replay to %s failed: %s", str(datetime.now()), record['path'], e)
+            return False
+
+
+
+_spools = {}
+_spools_lock = Lock()
+
+
+# return the process-wide spool for filename, with its replay thread running
+def open_spool(filename, size=4*1024*1024, shared=False):
+    with _spools_lock:
+        entry = _spools.get(filename)
+        if entry is None:
+            spool = PublishSpool(filename, size)
+            replay = SpoolReplay(spool, shared=shared)
+            replay.start()
+            entry = (spool, replay)
+            _spools[filename] = entry
+        return entry
@@ -0,0 +1,179 @@
+import re
+
+'''
+
+Constant-memory estimators for the beacon aggregation modes beyond last/mean/min/max
+
+P2Quantile  - P-square streaming quantile estimate (Jain & Chlamtac), used for median and pNN
+TrimmedMean - mean of the samples between two streaming quantiles
+Ewma        - exponentially weighted moving average, carried across windows
+
+Each estimator keeps a fixed amount of state per beacon and costs O(1) per sample.
+create_estimator() builds one from the mode name and the options in a mapping:
+
+  "median"       - 50th percentile
+  "p<NN>"        - NNth percentile, eg: "p90"
+  "trimmed"      - trimmed mean, "trim" is the fraction cut from each end (default 0.1)
+  "ewma"         - moving average, "alpha" is the smoothing factor (default 0.3)
+
+'''
+
+_PERCENTILE = re.compile(r'^p([0-9]{1,2})$')
+
+
+class P2Quantile:
+    def __init__(self, p):
+        self._p = float(p)
+        self._dn = [0.0, self._p / 2, self._p, (1 + self._p) / 2, 1.0]
+        self.reset()
+
+
+    def reset(self):
+        self._count = 0
+        self._q = []
+        self._n = [0, 1, 2, 3, 4]
+        self._np = [0.0, 2 * self._p, 4 * self._p, 2 + 2 * self._p, 4.0]
+
+
+    def carry(self, other):
+        pass
+
+
+    # beacontools delivers RSSI as ints, which would make the parabolic step floor-divide
+    def add(self, x):
+        x = float(x)
+        self._count += 1
+        q = self._q
+        if self._count <= 5:
+            q.append(x)
+            q.sort()
+            return
+
+        n = self._n
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self._np[i] += self._dn[i]
+
+        for i in (1, 2, 3):
+            d = self._np[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                qp = q[i] + float(d) / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+                    (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if not q[i - 1] < qp < q[i + 1]:
+                    qp = q[i] + float(d) * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = qp
+                n[i] += d
+
+
+    def value(self):
+        if self._count == 0:
+            return None
+        if self._count <= 5:
+            # exact quantile of the few samples seen so far
+            pos = self._p * (len(self._q) - 1)
+            lo = int(pos)
+            hi = min(lo + 1, len(self._q) - 1)
+            return self._q[lo] + (pos - lo) * (self._q[hi] - self._q[lo])
+        return self._q[2]
+
+
+
+class TrimmedMean:
+    def __init__(self, trim):
+        self._lo = P2Quantile(trim)
+        self._hi = P2Quantile(1 - trim)
+        self.reset()
+
+
+    def reset(self):
+        self._lo.reset()
+        self._hi.reset()
+        self._total = 0.0
+        self._count = 0
+
+
+    def carry(self, other):
+        pass
+
+
+    # samples are kept if they fall between the running quantile estimates
+    def add(self, x):
+        self._lo.add(x)
+        self._hi.add(x)
+        if self._lo.value() <= x <= self._hi.value():
+            self._total += x
+            self._count += 1
+
+
+    def value(self):
+        if self._count == 0:
+            return self._lo.value()
+        return self._total / self._count
+
+
+
+class Ewma:
+    def __init__(self, alpha):
+        self._alpha = float(alpha)
+        self._value = None
+
+
+    # the average carries over from one window to the next
+    def reset(self):
+        pass
+
+
+    # continue from the average of the previous window's buffer
+    def carry(self, other):
+        self._value = other._value
+
+
+    def add(self, x):
+        if self._value is None:
+            self._value = float(x)
+        else:
+            self._value += self._alpha * (x - self._value)
+
+
+    def value(self):
+        return self._value
+
+
+
+# True if mode is one of the basic modes or a streaming one
+def valid_mode(mode):
+    return mode in ['last', 'mean', 'min', 'max', 'median', 'trimmed', 'ewma'] or _PERCENTILE.match(mode) is not None
+
+
+# create the estimator for a streaming mode, or None for the basic modes
+def create_estimator(mode, options):
+    if mode == 'median':
+        return P2Quantile(0.5)
+    if mode == 'trimmed':
+        trim = float(options.get('trim', 0.1))
+        if not 0 <= trim < 0.5:
+            raise ValueError("trim must be between 0 and 0.5: {0}".format(trim))
+        return TrimmedMean(trim)
+    if mode == 'ewma':
+        alpha = float(options.get('alpha', 0.3))
+        if not 0 < alpha <= 1:
+            raise ValueError("alpha must be between 0 and 1: {0}".format(alpha))
+        return Ewma(alpha)
+    m = _PERCENTILE.match(mode)
+    if m is not None:
+        return P2Quantile(int(m.group(1)) / 100.0)
+    return None
@@ -1,15 +1,20 @@
-import yaml
 import json
 import logging
-import sdw
 import time
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 from datetime import datetime
-
-import os
+from MqttConnections import create_publisher, close_publisher
+from PublishSpool import open_spool
+from WindowScheduler import monotonic
+from Metrics import registry
+from HealthSensors import create_sensors
 
 logger = logging.getLogger(__name__)
 
+PUBLISHES = registry.counter("bt_temperature_publishes_total", "Temperature publications", ("result",))
+INTERVAL = registry.histogram("bt_temperature_publish_interval_seconds", "Time between temperature publications",
+                              buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0))
+
 
 class TemperatureScan(Thread):
     def __init__(self, configFile):
@@ -17,28 +22,78 @@ class TemperatureScan(Thread):
         self._stop_event = Event()
         self._running = False
         self._cfg = None
+        self._pub = None
+        self._sensors = None
+        self._pending = None
+        self._pending_lock = Lock()
         if configFile is not None:
             self.reload_configuration(configFile)
 
-    def reload_configuration(self, configFile):
+
+    def read_configuration(self, configFile):
         with open(configFile) as fp:
             if configFile.endswith("yaml"):
+                import yaml
                 temp = yaml.safe_load(fp)
             else:
                 temp = json.load(fp)
-        self._cfg = temp['temperature']
-        mqttaddr = self._cfg['mqtt']
-        if mqttaddr.startswith("tcp://"):
-            mqttaddr = mqttaddr[6:]
-        addr, port = mqttaddr.split(":")
-        self._path = self._cfg["sensor"]
-        self._pub = sdw.MQTT(addr, int(port), self._path)
-        self._frequency = float(self._cfg["frequency"]) / 1000
-        self._field = self._cfg["field"]
+        return temp['temperature']
+
+
+    def reload_configuration(self, configFile):
+        self.apply_pending(self.read_configuration(configFile), None)
+
+
+    # change the configuration of a running publisher, applied before its next reading;
+    # a stopped publisher is simply reconfigured
+    def apply_configuration(self, configFile):
+        if not self._running:
+            self.reload_configuration(configFile)
+            return
+        cfg = self.read_configuration(configFile)
+        sensors = create_sensors(cfg)
+        with self._pending_lock:
+            pending = self._pending
+            self._pending = (cfg, sensors)
+        if pending is not None:
+            pending[1].close()
+        logger.info("[%s] new temperature configuration will be applied at the next reading", str(datetime.now()))
+
+
+    # switch to cfg between readings, with its sensors if they were already created; the
+    # publisher is only replaced when the broker, path or connection sharing changed
+    def apply_pending(self, cfg, sensors):
+        old = self._cfg
+        self._cfg = cfg
+        self._frequency = float(cfg["frequency"]) / 1000
+        self._field = cfg["field"]
+
+        previous = self._sensors
+        self._sensors = sensors if sensors is not None else create_sensors(cfg)
+        if previous is not None:
+            previous.close()
+
+        keys = ['mqtt', 'sensor', 'shared_mqtt']
+        if old is None or any(old.get(k) != cfg.get(k) for k in keys):
+            if self._pub is not None:
+                if self._running:
+                    self._pub.publish_status("NOT_RUNNING")
+                close_publisher(self._pub)
+            self._path = cfg["sensor"]
+            self._pub = create_publisher(cfg['mqtt'], self._path, cfg.get('shared_mqtt', False))
+            if self._running:
+                self._pub.publish_status("RUNNING")
+
+        if old is None or any(old.get(k) != cfg.get(k) for k in ['spool_file', 'spool_size', 'shared_mqtt']):
+            self._spool = None
+            if 'spool_file' in cfg:
+                self._spool, self._replay = open_spool(cfg['spool_file'], cfg.get('spool_size', 4*1024*1024),
+                                                       cfg.get('shared_mqtt', False))
+
 
-    def measure_temp(self):
-        temp = os.popen("vcgencmd measure_temp").readline()
-        return float(temp.replace("temp=","").replace("'C",""))
+    # every health reading for this cycle as (field, value), see HealthSensors
+    def measure(self):
+        return self._sensors.read()
 
 
     def stop(self):
@@ -55,14 +110,34 @@ class TemperatureScan(Thread):
 
         self._pub.publish_status("RUNNING")
         self._running = True
+        last = None
         while not self._stop_event.is_set():
-            t = self.measure_temp()
-            payload = [ self._pub.create_value(self._field, t) ]
+            with self._pending_lock:
+                pending = self._pending
+                self._pending = None
+            if pending is not None:
+                self.apply_pending(pending[0], pending[1])
+            readings = self.measure()
+            if not readings:
+                logger.debug("[%s] no health readings to publish", str(datetime.now()))
+                time.sleep(self._frequency)
+                continue
+            payload = [ self._pub.create_value(f, v) for f, v in readings ]
             success = self._pub.publish_values(payload)
+            now = monotonic()
+            if last is not None:
+                INTERVAL.observe(now - last)
+            last = now
+            PUBLISHES.inc(1, ("success" if success else "failure",))
             if success:
-                logger.debug("[%s] temperature published %f to %s:%s", str(datetime.now()), float(t), self._path, self._field)
+                logger.debug("[%s] health published %s to %s", str(datetime.now()), readings, self._path)
+                if self._spool is not None:
+                    self._replay.kick()
             else:
-                logger.error("[%s] error publishing temperature %f on %s:%s", str(datetime.now()), t, self._path, self._field)
+                logger.error("[%s] error publishing health %s on %s", str(datetime.now()), readings, self._path)
+                if self._spool is not None:
+                    self._spool.append(self._cfg['mqtt'], self._path,
+                                       {"datetime": datetime.utcnow().isoformat() + "Z", "values": payload})
             time.sleep(self._frequency)
 
         logger.info("[%s] Stop Event received - shutting down temperature publisher", str(datetime.now()))
@@ -0,0 +1,212 @@
+import os
+import mmap
+import struct
+import logging
+from threading import Lock
+from datetime import datetime
+
+
+logger = logging.getLogger(__name__)
+
+
+'''
+
+Local history of closed windows, kept on the receiver's disk
+
+WindowHistory - appends the aggregates of every closed window to a rotating log
+read_history  - returns the windows of one path in a time range
+
+The log is a fixed-width file: a header holding the magic, version, header size and
+a table of "path<TAB>field" names, followed by 32 byte records of (timestamp, name
+index, count, min, max, mean, last). Records are appended in time order, so a time
+range is found by binary search over the memory-mapped file and only the records in
+the range are read. The name table only grows; a reader that sees an older, shorter
+table still sees every name its records refer to. When a window's names don't fit in
+the table the file is rotated and the new file gets a header with room for twice
+those names, so a large mapping costs one rotation rather than one per window.
+
+When a file reaches its size limit it is renamed to <file>.1 (and .1 to .2, ...) like
+logging's RotatingFileHandler, keeping "backups" old files.
+
+'''
+
+_MAGIC = 'BTWH'
+_VERSION = 2
+_HEADER = struct.Struct('<4sIII')
+_HEADER_SIZE = 16384
+_PAGE = 4096
+# version 1 files had a fixed size header without the size field
+_V1_HEADER = struct.Struct('<4sII')
+_RECORD = struct.Struct('<dIIffff')
+
+
+class WindowHistory:
+    def __init__(self, filename, max_bytes=8*1024*1024, backups=3):
+        self._filename = filename
+        self._max_bytes = int(max_bytes)
+        self._header_size = _HEADER_SIZE
+        self._backups = int(backups)
+        self._lock = Lock()
+        self._fp = None
+        self._open()
+
+
+    # append the closed window's aggregates, rows are (path, field, count, min, max, mean, last)
+    def append(self, timestamp, rows):
+        with self._lock:
+            if self._size > self._header_size and self._size + _RECORD.size * len(rows) > self._max_bytes:
+                self._rotate()
+            keys = [ self._key(r[0], r[1]) for r in rows ]
+            if None in keys:
+                needed = _HEADER.size + sum(len(r[0]) + len(r[1]) + 2 for r in rows)
+                empty = self._size == self._header_size
+                self._header_size = max(self._header_size, (2 * needed + _PAGE - 1) // _PAGE * _PAGE)
+                if empty:
+                    # nothing recorded yet, start the file again with the larger header
+                    self._fp.close()
+                    os.remove(self._filename)
+                    self._open()
+                else:
+                    self._rotate()
+                keys = [ self._key(r[0], r[1]) for r in rows ]
+            if None in keys:
+                logger.error("[%s] history %s name table full, %d rows not recorded", str(datetime.now()),
+                             self._filename, keys.count(None))
+            data = ''.join(_RECORD.pack(timestamp, key, *r[2:]) for key, r in zip(keys, rows) if key is not None)
+            self._fp.seek(self._size)
+            self._fp.write(data)
+            self._fp.flush()
+            self._size += len(data)
+
+
+    def close(self):
+        with self._lock:
+            self._fp.close()
+
+
+    # index of path/field in the name table, adding it; None if the table is full
+    def _key(self, path, field):
+        name = path + '\t' + field
+        key = self._keys.get(name)
+        if key is not None:
+            return key
+        line = name + '\n'
+        if _HEADER.size + self._names_size + len(line) > self._header_size:
+            return None
+        key = len(self._keys)
+        self._fp.seek(_HEADER.size + self._names_size)
+        self._fp.write(line)
+        self._names_size += len(line)
+        self._fp.seek(0)
+        self._fp.write(_HEADER.pack(_MAGIC, _VERSION, self._header_size, self._names_size))
+        self._keys[name] = key
+        return key
+
+
+    def _open(self):
+        size = os.path.getsize(self._filename) if os.path.exists(self._filename) else 0
+        self._fp = open(self._filename, 'r+b' if size else 'w+b')
+        header = _read_header(self._fp.read(_HEADER.size)) if size >= _HEADER.size else None
+        if header is not None and header[0] != _VERSION:
+            # keep an older version's windows readable as a backup, and start a new file
+            self._rotate()
+            return
+        if header is None or size < header[1]:
+            self._fp.seek(0)
+            self._fp.truncate()
+            self._fp.write(_HEADER.pack(_MAGIC, _VERSION, self._header_size, 0).ljust(self._header_size, '\0'))
+            names = []
+            size = self._header_size
+        else:
+            version, self._header_size, offset, names_size = header
+            self._fp.seek(offset)
+            names = self._fp.read(names_size).split('\n')[:-1]
+        self._keys = dict((n, i) for i, n in enumerate(names))
+        self._names_size = sum(len(n) + 1 for n in names)
+        # drop a partly written record left by a crash
+        self._size = size - (size - self._header_size) % _RECORD.size
+
+
+    def _rotate(self):
+        self._fp.close()
+        for i in range(self._backups - 1, 0, -1):
+            older = "{0}.{1}".format(self._filename, i)
+            if os.path.exists(older):
+                os.rename(older, "{0}.{1}".format(self._filename, i + 1))
+        if self._backups > 0:
+            os.rename(self._filename, self._filename + ".1")
+        else:
+            os.remove(self._filename)
+        self._open()
+        logger.info("[%s] history %s rotated", str(datetime.now()), self._filename)
+
+
+
+# (version, header size, names offset, names size) from the start of a file, None if
+# it isn't a history file
+def _read_header(data):
+    if len(data) < _HEADER.size:
+        return None
+    magic, version, size, names_size = _HEADER.unpack_from(data, 0)
+    if magic != _MAGIC:
+        return None
+    if version == 1:
+        return 1, _HEADER_SIZE, _V1_HEADER.size, size
+    if version == _VERSION:
+        return version, size, _HEADER.size, names_size
+    return None
+
+
+# windows of path between start and end (unix seconds), oldest first, from the
+# rotated files and the current one
+def read_history(filename, path, start=None, end=None, backups=3, limit=10000):
+    rows = []
+    files = [ "{0}.{1}".format(filename, i) for i in range(backups, 0, -1) ] + [filename]
+    for f in files:
+        if os.path.exists(f) and len(rows) < limit:
+            rows.extend(_read_file(f, path, start, end, limit - len(rows)))
+    return rows
+
+
+def _read_file(filename, path, start, end, limit):
+    with open(filename, 'rb') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        header = _read_header(fp.read(_HEADER.size))
+        if header is None:
+            return []
+        version, header_size, offset, names_size = header
+        count = (size - header_size) // _RECORD.size if size >= header_size else 0
+        if count <= 0:
+            return []
+        m = mmap.mmap(fp.fileno(), header_size + count * _RECORD.size, access=mmap.ACCESS_READ)
+        try:
+            names = m[offset:offset + names_size].split('\n')[:-1]
+            fields = dict((i, n.split('\t', 1)[1]) for i, n in enumerate(names) if n.split('\t', 1)[0] == path)
+            if not fields:
+                return []
+            lo = 0 if start is None else _search(m, header_size, count, start)
+            hi = count if end is None else _search(m, header_size, count, end, True)
+            rows = []
+            for i in xrange(lo, hi):
+                ts, key, n, mn, mx, mean, last = _RECORD.unpack_from(m, header_size + i * _RECORD.size)
+                if key in fields:
+                    rows.append({"timestamp": ts, "field": fields[key], "count": n,
+                                 "min": mn, "max": mx, "mean": mean, "last": last})
+                    if len(rows) >= limit:
+                        break
+            return rows
+        finally:
+            m.close()
+
+
+# first record with a timestamp >= t (> t when after is True)
+def _search(m, header_size, count, t, after=False):
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        ts = _RECORD.unpack_from(m, header_size + mid * _RECORD.size)[0]
+        if ts < t or (after and ts == t):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
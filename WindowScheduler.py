@@ -0,0 +1,92 @@
+import os
+import ctypes
+import ctypes.util
+
+
+'''
+
+Deadline based scheduling of aggregation windows
+
+WindowScheduler ticks every period seconds against a monotonic clock. Each deadline is
+computed from the previous deadline rather than from when the caller finished its
+work, so time spent publishing does not make the period drift. The lateness of each
+tick (jitter) is tracked, and ticks missed because a window overran are skipped and
+counted instead of being run back to back.
+
+'''
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+try:
+    _librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+    _clock_gettime = _librt.clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+except (OSError, AttributeError):
+    _clock_gettime = None
+
+_CLOCK_MONOTONIC = 1
+
+
+# seconds from an arbitrary starting point, never goes backwards
+def monotonic():
+    if _clock_gettime is not None:
+        t = _timespec()
+        if _clock_gettime(_CLOCK_MONOTONIC, ctypes.pointer(t)) == 0:
+            return t.tv_sec + t.tv_nsec * 1e-9
+    return os.times()[4]
+
+
+class WindowScheduler:
+    def __init__(self, period):
+        self._period = float(period)
+        self._next = None
+        self._windows = 0
+        self._overruns = 0
+        self._last_jitter = 0.0
+        self._max_jitter = 0.0
+        self._total_jitter = 0.0
+
+
+    def start(self):
+        self._next = monotonic() + self._period
+
+
+    def set_period(self, period):
+        self._period = float(period)
+
+
+    # wait for the next deadline; returns False if stop_event was set while waiting
+    def wait(self, stop_event):
+        remaining = self._next - monotonic()
+        if remaining > 0 and stop_event.wait(remaining):
+            return False
+        if stop_event.is_set():
+            return False
+
+        now = monotonic()
+        jitter = now - self._next
+        self._windows += 1
+        self._last_jitter = jitter
+        self._total_jitter += jitter
+        if jitter > self._max_jitter:
+            self._max_jitter = jitter
+
+        self._next += self._period
+        if self._next <= now:
+            missed = int((now - self._next) / self._period) + 1
+            self._overruns += missed
+            self._next += missed * self._period
+        return True
+
+
+    # per window timing, jitter values in milliseconds
+    def stats(self):
+        return {"windows": self._windows,
+                "period_ms": self._period * 1000,
+                "last_jitter_ms": self._last_jitter * 1000,
+                "max_jitter_ms": self._max_jitter * 1000,
+                "mean_jitter_ms": self._total_jitter * 1000 / self._windows if self._windows else 0.0,
+                "overruns": self._overruns}
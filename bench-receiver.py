@@ -0,0 +1,157 @@
+import os
+import sys
+import json
+import time
+import types
+import random
+import argparse
+import resource
+import tempfile
+
+'''
+
+Throughput benchmark for the receiver pipeline, no Bluetooth hardware needed
+
+Drives BeaconScanAndPublish.beacon_callback with synthetic Eddystone instance/RSSI
+streams while the real window loop aggregates and publishes. sdw.MQTT is replaced by
+an in-process stand-in that only counts publications, and the BLE scanner by one
+that does nothing.
+
+Run with: python bench-receiver.py -b 80 -u 20 -r 0 -d 10 -f 1000
+
+-r 0 sends advertisements as fast as possible, otherwise at that many per second.
+
+'''
+
+RUSAGE_THREAD = 1
+
+
+class CountingMQTT(object):
+    values = 0
+    publishes = 0
+
+    def __init__(self, addr, port, path):
+        self._path = path
+
+    def create_value(self, field, value):
+        return {"field": field, "amount": value, "attributes": {}}
+
+    def create_status_payload(self, status, message):
+        return {"status": status, "message": message}
+
+    def publish(self, subtopic, payload):
+        return True
+
+    def publish_values(self, values):
+        CountingMQTT.publishes += 1
+        CountingMQTT.values += len(values)
+        return True
+
+    def publish_status(self, status):
+        return True
+
+
+class IdleScanner(object):
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+sdw = types.ModuleType("sdw")
+sdw.MQTT = CountingMQTT
+sys.modules["sdw"] = sdw
+
+import BeaconData
+
+
+def thread_cpu():
+    r = resource.getrusage(RUSAGE_THREAD)
+    return r.ru_utime + r.ru_stime
+
+
+# wrap the window work so its CPU time is measured on the scan thread
+def measure_windows(scanner, cpu_times):
+    swap = scanner.swap_buffers
+    publish = scanner._publishers.publish_window
+    state = {}
+
+    def timed_swap():
+        state['start'] = thread_cpu()
+        return swap()
+
+    def timed_publish(window):
+        publish(window)
+        cpu_times.append(thread_cpu() - state['start'])
+
+    scanner.swap_buffers = timed_swap
+    scanner._publishers.publish_window = timed_publish
+
+
+def create_config(args):
+    mappings = [{"sensor": "{0:012x}".format(i), "path": "/Bench/Beacons/B{0}".format(i), "field": "rssi"}
+                for i in range(args.beacons)]
+    cfg = {"beacons": {"name": "bench", "mode": args.mode, "frequency": args.frequency,
+                       "namespace": "69788673717376657884", "mqtt": "tcp://localhost:1883",
+                       "shared_mqtt": False, "batch": args.batch, "batch_path": "/Bench/Receiver",
+                       "mappings": mappings}}
+    fd, filename = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(fd, "w") as fp:
+        json.dump(cfg, fp)
+    return filename
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="benchmark the receiver's beacon callback and window loop")
+    ap.add_argument("-b", "--beacons", type=int, default=80, help="mapped beacons")
+    ap.add_argument("-u", "--unknown", type=int, default=20, help="unmapped beacons also advertising")
+    ap.add_argument("-r", "--rate", type=float, default=0, help="advertisements/sec, 0 for as fast as possible")
+    ap.add_argument("-d", "--duration", type=float, default=10, help="seconds to run")
+    ap.add_argument("-f", "--frequency", type=int, default=1000, help="window length in ms")
+    ap.add_argument("-m", "--mode", default="mean")
+    ap.add_argument("--batch", default=None, choices=["path", "receiver"])
+    args = ap.parse_args()
+
+    filename = create_config(args)
+    scanner = BeaconData.BeaconScanAndPublish(filename)
+    os.remove(filename)
+    scanner._scanner = IdleScanner()
+    cpu_times = []
+    measure_windows(scanner, cpu_times)
+
+    ids = ["{0:012x}".format(i) for i in range(args.beacons + args.unknown)]
+    frames = [{"namespace": "69788673717376657884", "instance": random.choice(ids)} for i in range(10007)]
+    rssi = [random.randint(-95, -40) for i in range(10007)]
+    callback = scanner.beacon_callback
+
+    scanner.start()
+    sent = 0
+    start = time.time()
+    end = start + args.duration
+    chunk = 1000 if args.rate <= 0 else max(1, int(args.rate / 100))
+    while True:
+        now = time.time()
+        if now >= end:
+            break
+        if args.rate > 0 and sent > (now - start) * args.rate:
+            time.sleep(0.005)
+            continue
+        for i in range(sent, sent + chunk):
+            j = i % 10007
+            callback(None, rssi[j], None, frames[j])
+        sent += chunk
+    elapsed = time.time() - start
+    scanner.stop()
+    scanner.join()
+
+    windows = scanner.window_stats()
+    print "advertisements     {0} in {1:.1f}s".format(sent, elapsed)
+    print "callbacks/sec      {0:.0f}".format(sent / elapsed)
+    print "windows            {0} ({1} overruns)".format(windows['windows'], windows['overruns'])
+    if cpu_times:
+        print "window cpu ms      mean {0:.2f}  max {1:.2f}".format(sum(cpu_times) * 1000 / len(cpu_times),
+                                                                    max(cpu_times) * 1000)
+    print "window jitter ms   mean {0:.2f}  max {1:.2f}".format(windows['mean_jitter_ms'], windows['max_jitter_ms'])
+    print "publish calls      {0} ({1} values)".format(CountingMQTT.publishes, CountingMQTT.values)
+    print "unknown beacons    {0}".format(sum(scanner._unknown.counts()['beacons'].values()))
@@ -0,0 +1,98 @@
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import urllib2
+import argparse
+import tempfile
+import subprocess
+from threading import Thread
+
+'''
+
+Cold start benchmark for bt-manager
+
+Starts bt-manager under "flask run" with its own $BT_HOME and measures the time from
+launching the process to the first successful response from /. The stored
+configuration has check-in items pointing at a controller that accepts connections
+but never answers, the worst case for a receiver booting while its controller hangs.
+
+Run with: python bench-startup.py -r 5
+
+'''
+
+
+# a controller that accepts the check-in connection and then never replies
+def silent_controller():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    s.listen(16)
+    held = []
+
+    def accept():
+        while True:
+            held.append(s.accept()[0])
+
+    t = Thread(target=accept)
+    t.daemon = True
+    t.start()
+    return "http://127.0.0.1:{0}/ble/check-in".format(s.getsockname()[1])
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+# seconds from launch to the first response from /, None if there was none in time
+def time_to_first_response(home, timeout):
+    port = free_port()
+    env = dict(os.environ, BT_HOME=home, FLASK_APP=os.path.join(os.path.dirname(os.path.abspath(__file__)), "bt-manager.py"))
+    start = time.time()
+    p = subprocess.Popen([sys.executable, "-m", "flask", "run", "--port", str(port)], env=env,
+                         stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+    try:
+        while time.time() - start < timeout:
+            try:
+                urllib2.urlopen("http://127.0.0.1:{0}/".format(port), timeout=1).read()
+                return time.time() - start
+            except (IOError, socket.error):
+                if p.poll() is not None:
+                    return None
+                time.sleep(0.01)
+        return None
+    finally:
+        # a child that failed to start has already been reaped by poll()
+        if p.poll() is None:
+            p.kill()
+            p.wait()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="time from starting bt-manager to its first / response")
+    ap.add_argument("-r", "--runs", type=int, default=5)
+    ap.add_argument("-t", "--timeout", type=float, default=60, help="seconds to wait for a response")
+    ap.add_argument("-i", "--interface", default="lo", help="interface reported in the check-in")
+    args = ap.parse_args()
+
+    home = tempfile.mkdtemp()
+    with open(os.path.join(home, "store-config.json"), "w") as fp:
+        json.dump({"version": "bench", "name": "bench", "interface": args.interface,
+                   "controller": silent_controller(), "beacons": {}, "temperature": {}}, fp)
+
+    times = []
+    for i in range(args.runs):
+        t = time_to_first_response(home, args.timeout)
+        print "run {0}: {1}".format(i + 1, "no response" if t is None else "{0:.0f}ms".format(t * 1000))
+        if t is not None:
+            times.append(t)
+    shutil.rmtree(home)
+    if times:
+        times.sort()
+        print "first / response   min {0:.0f}ms  median {1:.0f}ms  max {2:.0f}ms".format(
+            times[0] * 1000, times[len(times) // 2] * 1000, times[-1] * 1000)
@@ -1,14 +1,18 @@
 from flask import Flask
 from flask import request
+from flask import Response
 import BeaconData
 from TemperatureScan import TemperatureScan
+from Metrics import registry
+from WindowHistory import read_history
 import json
+import time
 import sys
 import traceback
 import logging
 from datetime import datetime
-from urllib import urlopen
-import netifaces as ni
+import os
+from CheckIn import CheckIn
 
 '''
 
@@ -20,34 +24,38 @@ curl -X POST --data @config.json --header "Content-Type:application/json" http:/
 start:  curl -X GET http://localhost:5000/start/{all,beacons,temperature}
 stop:   curl -X GET http://localhost:5000/stop/{all,beacons,temperature}
 status: curl -X GET http://localhost:5000
+metrics: curl -X GET http://localhost:5000/metrics
+history: curl -X GET "http://localhost:5000/history/<path>?start=<unix secs>&end=<unix secs>"
+
+The log and stored configuration live in $BT_HOME (default /home/pi/bt). With "name",
+"interface" and "controller" in the stored configuration the receiver checks in with
+the controller in the background, every "checkin_heartbeat" seconds (default 300).
 '''
 
 app = Flask(__name__)
-logging.basicConfig(filename="/home/pi/bt/flask.log", level=logging.DEBUG)
+bt_home = os.environ.get("BT_HOME", "/home/pi/bt")
+logging.basicConfig(filename=bt_home+"/flask.log", level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
 total = 0
 count = 0
 config_loaded = False
-config_stash = "/home/pi/bt/store-config.json"
+config_stash = bt_home+"/store-config.json"
 config_version = None
 scanner = None
 temp_scanner = None
+checkin = None
 
 def init():
-    global config_stash
+    global config_stash, checkin
     try:
         with open(config_stash,"r") as fp:
             cfg = json.load(fp)
         if 'name' in cfg and 'interface' in cfg and 'controller' in cfg:
-            if cfg["interface"] in ni.interfaces():
-                ip = ni.ifaddresses(cfg["interface"])[ni.AF_INET][0]['addr']
-                info = {"name": cfg["name"], "controller": cfg["controller"], "address": ip, "interface": cfg["interface"]}
-                r = urlopen(cfg["controller"], data="json="+json.dumps(info))
-                logger.info("[%s] result from check-in: %s", str(datetime.now()), r.read())
-            else:
-                logger.warning("[%s] interface %s doesn't exist, can't check in", str(datetime.now()), cfg["interface"])
+            checkin = CheckIn(cfg, timeout=cfg.get('checkin_timeout', 5),
+                              heartbeat=cfg.get('checkin_heartbeat', 300))
+            checkin.start()
         else:
             logger.info("[%s] config doesn't have check-in items", str(datetime.now()))
         
@@ -59,7 +67,7 @@ def init():
     
 @app.route('/')
 def running_status():
-    global scanner, temp_scanner, config_version
+    global scanner, temp_scanner, config_version, checkin
     if scanner is None or not scanner._running:
         s = "stopped"
     else:
@@ -71,18 +79,38 @@ def running_status():
         t = "running"
         
     status = {"status":{"beacons":s,"temperature":t}, "version": config_version}
+    if s == "running":
+        status["windows"] = scanner.window_stats()
+        status["published"] = scanner.publish_stats()
+        status["filter"] = scanner.filter_stats()
+    if checkin is not None:
+        status["checkin"] = checkin.stats()
     return json.dumps(status)
 
 
+@app.route('/metrics')
+def metrics():
+    global scanner
+    if scanner is not None:
+        scanner.collect_metrics()
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route('/config', methods=['POST'])
 def load_config():
-    global request, config_loaded, confg_stash, config_version
+    global request, config_loaded, confg_stash, config_version, scanner, temp_scanner
     try:
         data = json.loads(request.data)
         with open(config_stash,"w") as fp:
             json.dump(data,fp)
         config_version = data["version"]
         config_loaded = True
+
+        # running publishers pick up the new configuration in place
+        if scanner is not None and 'beacons' in data:
+            scanner.apply_configuration(config_stash)
+        if temp_scanner is not None and 'temperature' in data:
+            temp_scanner.apply_configuration(config_stash)
         return json.dumps({"status":"success"})
     except Exception as e:
         return handle_exception(e)
@@ -120,6 +148,25 @@ def stop_publishing(ind):
     except Exception as e:
         return handle_exception(e)
 
+
+
+# windows recorded for a path, the last hour unless start/end (unix seconds) are given
+@app.route('/history/<path:path>')
+def history(path):
+    global config_stash
+    try:
+        with open(config_stash,"r") as fp:
+            cfg = json.load(fp)['beacons']
+        if 'history_file' not in cfg:
+            return json.dumps({"status":"failure", "reason":"No history_file configured"})
+        end = float(request.args.get('end', time.time()))
+        start = float(request.args.get('start', end - 3600))
+        rows = read_history(cfg['history_file'], '/' + path, start, end, cfg.get('history_backups', 3),
+                            int(request.args.get('limit', 10000)))
+        return json.dumps({"status":"success", "path": '/' + path, "windows": rows})
+    except Exception as e:
+        return handle_exception(e)
+
     
 @app.route('/ble', methods=['POST'])
 def show_payload():
@@ -0,0 +1,174 @@
+import time
+import logging
+import requests
+from threading import Thread, Event, Lock
+from datetime import datetime
+
+'''
+' Write-behind poster for bt_beacon_detection upserts
+'
+' Detections are buffered and sent to the REST resource as one bulk upsert (a JSON
+' list of updates) when either the buffer holds flush_size detections or the oldest
+' buffered detection is max_latency seconds old. With flush_size of 1 each update is
+' posted on its own, as a single object, which matches the original behaviour.
+'
+' With coalesce set to a number of seconds, detections with the same upsert keys
+' (beacon, receiver and mode) are merged while buffered: only the one with the newest
+' field_timestamp is posted, since the backend keeps only the latest row per key
+' anyway. The buffer is then flushed only when its oldest entry is coalesce seconds
+' old, in bulk posts of up to flush_size. Merged detections are counted as absorbed.
+'
+' At most max_pending detections are buffered. While the REST backend is down the
+' poster is busy retrying, and once the buffer is full the oldest flush_size
+' detections are dropped to make room, counted as dropped.
+'''
+
+
+class DetectionPoster(Thread):
+    def __init__(self, session, resource, flush_size=50, max_latency=2.0, retries=3, retry_delay=0.5, coalesce=0,
+                 max_pending=10000):
+        Thread.__init__(self)
+        self.daemon = True
+        self._session = session
+        self._resource = resource
+        self._flush_size = max(1, int(flush_size))
+        self._coalesce = float(coalesce) > 0
+        self._max_latency = float(coalesce) if self._coalesce else float(max_latency)
+        self._retries = max(1, int(retries))
+        self._retry_delay = float(retry_delay)
+        self._max_pending = max(self._flush_size, int(max_pending))
+        self._buffer = []
+        self._keys = {}
+        self._oldest = None
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._wake = Event()
+        self._stop_event = Event()
+        self._posted = 0
+        self._batches = 0
+        self._failed = 0
+        self._absorbed = 0
+        self._dropped = 0
+        self._logger = logging.getLogger(__name__)
+
+
+    # queue one detection update, waking the flusher if the buffer is full
+    def add(self, update):
+        with self._lock:
+            if self._coalesce:
+                key = tuple(sorted(update['keys'].items()))
+                i = self._keys.get(key)
+                if i is not None:
+                    current = self._buffer[i]
+                    if update['values'].get('field_timestamp') >= current['values'].get('field_timestamp'):
+                        self._buffer[i] = update
+                    self._absorbed += 1
+                    return
+            if len(self._buffer) >= self._max_pending:
+                self._drop_oldest()
+            if self._coalesce:
+                self._keys[key] = len(self._buffer)
+            if self._oldest is None:
+                self._oldest = time.time()
+            self._buffer.append(update)
+            full = not self._coalesce and len(self._buffer) >= self._flush_size
+        if full:
+            self._wake.set()
+
+
+    # number of detections waiting to be posted
+    def pending(self):
+        return len(self._buffer)
+
+
+    def stats(self):
+        return {"pending": self.pending(),
+                "posted": self._posted,
+                "batches": self._batches,
+                "failed": self._failed,
+                "absorbed": self._absorbed,
+                "dropped": self._dropped}
+
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake.set()
+        if self.is_alive():
+            self.join(self._max_latency + self._retries * self._retry_delay * 4 + 5)
+        else:
+            self.flush()
+
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self._wake.wait(self._time_to_flush())
+            self._wake.clear()
+            if self._due():
+                self.flush()
+        self.flush()
+        self._logger.info("[%s] detection poster stopped: %s", str(datetime.now()), self.stats())
+
+
+    # post everything currently buffered
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch = self._buffer
+                self._buffer = []
+                self._keys = {}
+                self._oldest = None
+            while batch:
+                chunk = batch[:self._flush_size]
+                batch = batch[self._flush_size:]
+                self._post(chunk)
+
+
+    # make room in a full buffer, called with the lock held
+    def _drop_oldest(self):
+        n = self._flush_size
+        del self._buffer[:n]
+        if self._coalesce:
+            self._keys = dict((k, i - n) for k, i in self._keys.iteritems() if i >= n)
+        self._dropped += n
+        if self._dropped % (100 * n) < n:
+            self._logger.warning("[%s] detection buffer full, %d detections dropped so far",
+                                 str(datetime.now()), self._dropped)
+
+
+    def _due(self):
+        with self._lock:
+            if not self._buffer:
+                return False
+            full = not self._coalesce and len(self._buffer) >= self._flush_size
+            return full or time.time() - self._oldest >= self._max_latency
+
+
+    def _time_to_flush(self):
+        with self._lock:
+            if self._oldest is None:
+                return self._max_latency
+            return max(0.0, self._oldest + self._max_latency - time.time())
+
+
+    def _post(self, chunk):
+        body = chunk[0] if len(chunk) == 1 else chunk
+        for attempt in range(self._retries):
+            try:
+                r = self._session.post(self._resource, body)
+                if r.ok:
+                    self._logger.debug("[%s] Data post results (%d detections): %s",
+                                       str(datetime.now()), len(chunk), r.text)
+                    self._posted += len(chunk)
+                    self._batches += 1
+                    return True
+                reason = r.reason
+            except requests.RequestException as e:
+                reason = e
+            self._logger.warning("[%s] detection post attempt %d of %d failed: %s",
+                                 str(datetime.now()), attempt + 1, self._retries, reason)
+            if attempt + 1 < self._retries:
+                time.sleep(self._retry_delay * (2 ** attempt))
+        self._failed += len(chunk)
+        self._logger.error("[%s] dropped %d detections after %d attempts",
+                           str(datetime.now()), len(chunk), self._retries)
+        return False
@@ -0,0 +1,136 @@
+import time
+import logging
+from threading import Thread, Lock
+from datetime import datetime
+from Queue import Queue, Full, Empty
+
+'''
+' Ingestion pipeline between the paho network thread and message processing
+'
+' The MQTT on_message callback only calls submit(), which never blocks: messages go
+' into bounded queues and a fixed pool of worker threads does the decoding, index
+' lookups and REST posting, so the worker count caps REST concurrency. Each worker
+' has its own queue and a message goes to the queue owning its topic path (the topic
+' without its last level), so one receiver's messages are handled in arrival order
+' and an older detection of a beacon@receiver is never posted after a newer one.
+' When a queue is full the overflow policy applies backpressure explicitly:
+'
+'   drop_oldest - discard the oldest message queued for that worker to make room (default)
+'   drop_newest - discard the incoming message
+'
+' queue_size is the total over all workers. Dropped messages are counted, and
+' depth()/stats() expose the queue state.
+'''
+
+_SENTINEL = object()
+
+
+class IngestPipeline:
+    def __init__(self, handler, queue_size=1000, workers=4, overflow='drop_oldest'):
+        if overflow not in ['drop_oldest', 'drop_newest']:
+            raise ValueError("unrecognized overflow policy: {0}".format(overflow))
+        self._handler = handler
+        self._worker_count = max(1, int(workers))
+        self._queues = [ Queue(maxsize=max(1, int(queue_size) // self._worker_count))
+                         for i in range(self._worker_count) ]
+        self._overflow = overflow
+        self._workers = []
+        self._lock = Lock()
+        self._received = 0
+        self._processed = 0
+        self._dropped = 0
+        self._errors = 0
+        self._high_water = 0
+        self._logger = logging.getLogger(__name__)
+
+
+    def start(self):
+        for i, queue in enumerate(self._queues):
+            t = Thread(target=self._work, args=(queue,), name="ingest-{0}".format(i))
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+
+    # let the workers drain the queue, then stop them
+    def stop(self, timeout=30):
+        for queue in self._queues:
+            queue.put(_SENTINEL)
+        for t in self._workers:
+            t.join(timeout)
+        self._workers = []
+        self._logger.info("[%s] ingest pipeline stopped: %s", str(datetime.now()), self.stats())
+
+
+    # queue a message for processing; returns False if a message had to be dropped
+    def submit(self, topic, payload):
+        item = (topic, payload, time.time())
+        path = topic.rsplit('/', 1)[0]
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        # not crc32: ListenerGroup picks a worker process by crc32 of the same path, and
+        # reusing it would send all of a process's paths to one queue
+        queue = self._queues[hash((path, 'ingest')) % self._worker_count]
+        self._received += 1
+        try:
+            queue.put_nowait(item)
+            self._note_depth()
+            return True
+        except Full:
+            pass
+
+        with self._lock:
+            self._dropped += 1
+            if self._overflow == 'drop_oldest':
+                try:
+                    queue.get_nowait()
+                    queue.task_done()
+                except Empty:
+                    pass
+                try:
+                    queue.put_nowait(item)
+                except Full:
+                    pass
+        if self._dropped % 100 == 1:
+            self._logger.warning("[%s] ingest queue full, %d messages dropped so far",
+                                 str(datetime.now()), self._dropped)
+        return False
+
+
+    def depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+
+    def stats(self):
+        return {"depth": self.depth(),
+                "capacity": sum(q.maxsize for q in self._queues),
+                "high_water": self._high_water,
+                "workers": self._worker_count,
+                "received": self._received,
+                "processed": self._processed,
+                "dropped": self._dropped,
+                "errors": self._errors}
+
+
+    def _note_depth(self):
+        d = self.depth()
+        if d > self._high_water:
+            self._high_water = d
+
+
+    def _work(self, queue):
+        while True:
+            item = queue.get()
+            if item is _SENTINEL:
+                queue.task_done()
+                return
+            topic, payload, arrival = item
+            try:
+                self._handler(topic, payload, arrival)
+                self._processed += 1
+            except Exception as e:
+                self._errors += 1
+                self._logger.error("[%s] error processing message on %s", str(datetime.now()), topic)
+                self._logger.error(e, exc_info=True)
+            finally:
+                queue.task_done()
@@ -0,0 +1,302 @@
+import os
+import zlib
+import logging
+import multiprocessing
+from threading import Thread, Event, Lock
+from datetime import datetime
+from Queue import Full
+import paho.mqtt.client as mqtt
+from MqttListener import MqttListener, parse_server
+
+'''
+' Sharded ingestion: N MqttListener worker processes run as one group
+'
+' Each worker is a separate process with its own REST session, object indexes,
+' ingest pipeline and detection poster, so JSON decoding and posting scale past the
+' GIL. The sdw/... traffic is split between workers by "shard_mode":
+'
+'   shared   - every worker subscribes to $share/<shard_group>/<topic> and the broker
+'              balances messages between them (needs an MQTT broker with shared
+'              subscriptions, eg: mosquitto 1.6+ or EMQX)
+'   dispatch - this process subscribes to the topic and forwards each message to the
+'              worker owning its topic path, so a receiver publishing in batch mode
+'              always lands on the same worker (default)
+'
+' Configuration items, on top of the MqttListener ones
+'
+' "shard_workers"     - number of worker processes (default: number of CPUs)
+' "shard_mode"        - shared or dispatch (default dispatch)
+' "shard_group"       - shared subscription group name (default bt-mqtt)
+' "shard_queue_size"  - messages buffered per worker in dispatch mode (default 1000)
+'
+' ListenerGroup offers the same start/stop/reload_configuration/ingest_stats calls as
+' MqttListener so mqtt-manager can control either one.
+'''
+
+_STOP = None
+
+
+class ListenerGroup:
+    def __init__(self):
+        self._cfg = None
+        self._ready_to_run = False
+        self._running = False
+        self._workers = []
+        self._client = None
+        self._monitor = None
+        self._stop_event = Event()
+        self._mode = None
+        self._count = 0
+        self._dispatched = 0
+        self._dropped = 0
+        self._restarts = 0
+        self._logger = logging.getLogger(__name__)
+
+
+    def reload_configuration(self, config):
+        mode = config.get('shard_mode', 'dispatch')
+        if mode not in ['shared', 'dispatch']:
+            self._logger.error("[%s] unrecognized shard_mode: %s", str(datetime.now()), mode)
+            return False
+        running = self._running
+        if running:
+            self.stop()
+        self._cfg = config
+        self._cfg['server'], self._cfg['port'] = parse_server(self._cfg['server'], self._cfg.get('port'))
+        self._mode = mode
+        self._count = max(1, int(config.get('shard_workers', multiprocessing.cpu_count())))
+        self._ready_to_run = True
+        if running:
+            self.start()
+        return True
+
+
+    def start(self):
+        if self._running:
+            self._logger.info("[%s] group start requested, stopping first", str(datetime.now()))
+            self.stop()
+        if not self._ready_to_run:
+            self._logger.error("[%s] listener group not ready to run", str(datetime.now()))
+            return False
+
+        self._logger.info("[%s] starting %d %s workers", str(datetime.now()), self._count, self._mode)
+        self._stop_event.clear()
+        self._workers = [ self._spawn(i) for i in range(self._count) ]
+        if self._mode == 'dispatch':
+            self._client = mqtt.Client()
+            self._client.on_connect = self.on_connect
+            self._client.on_message = self.on_message
+            self._client.connect(self._cfg['server'], int(self._cfg['port']), int(self._cfg['keepalive']))
+            self._client.loop_start()
+        self._monitor = Thread(target=self._supervise, name="listener-group")
+        self._monitor.daemon = True
+        self._monitor.start()
+        self._running = True
+        return True
+
+
+    def stop(self):
+        if not self._running:
+            self._logger.info("[%s] request to stop listener group that wasn't started", str(datetime.now()))
+            return
+        self._stop_event.set()
+        self._monitor.join()
+        if self._client is not None:
+            self._client.loop_stop()
+            self._client.disconnect()
+            self._client = None
+        for w in self._workers:
+            w.stop()
+        self._workers = []
+        self._running = False
+        self._logger.info("[%s] listener group stopped", str(datetime.now()))
+
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            client.subscribe(self._cfg['topic'])
+            self._logger.info("[%s] dispatcher connected to topic %s", str(datetime.now()), self._cfg['topic'])
+        else:
+            self._logger.error("[%s] dispatcher failed to connect, result code %d", str(datetime.now()), rc)
+
+
+    # forward to the worker owning the topic's path (the topic without its last level)
+    def on_message(self, client, userdata, msg):
+        path = msg.topic.rsplit('/', 1)[0]
+        worker = self._workers[zlib.crc32(path) % len(self._workers)]
+        if worker.submit(msg.topic, msg.payload):
+            self._dispatched += 1
+        else:
+            self._dropped += 1
+
+
+    # worker processes with their ingest counters, and the dispatcher counters
+    def ingest_stats(self):
+        stats = {"mode": self._mode,
+                 "restarts": self._restarts,
+                 "workers": [ w.status() for w in self._workers ]}
+        if self._client is not None:
+            stats['dispatched'] = self._dispatched
+            stats['dropped'] = self._dropped
+        return stats
+
+
+    # a beacon's detections from every worker, merged
+    def beacon_state(self, beacon):
+        states = [ s for s in (w.call(("beacon", beacon)) for w in self._workers) if s is not None ]
+        if not states:
+            return None
+        receivers = sorted(sum([ s['receivers'] for s in states ], []), key=lambda e: e['rssi'], reverse=True)
+        return {"beacon": beacon, "nearest": receivers[0]['receiver'], "receivers": receivers}
+
+
+    # a receiver's status and detections from every worker, merged
+    def receiver_state(self, receiver):
+        states = [ s for s in (w.call(("receiver", receiver)) for w in self._workers) if s is not None ]
+        if not states:
+            return None
+        merged = {"receiver": receiver, "beacons": sum([ s['beacons'] for s in states ], [])}
+        for s in sorted(states, key=lambda s: s.get('status_age'), reverse=True):
+            if 'status' in s:
+                merged['status'] = s['status']
+                merged['status_age'] = s['status_age']
+        return merged
+
+
+    def _spawn(self, index):
+        cfg = dict(self._cfg)
+        if self._mode == 'shared':
+            cfg['topic'] = "$share/{0}/{1}".format(self._cfg.get('shard_group', 'bt-mqtt'), self._cfg['topic'])
+        w = Worker(index, cfg, self._mode == 'dispatch', self._cfg.get('shard_queue_size', 1000))
+        w.start()
+        return w
+
+
+    # restart workers that died, eg: killed or crashed on a bad message
+    def _supervise(self):
+        while not self._stop_event.wait(5):
+            for i, w in enumerate(self._workers):
+                if not w.is_alive():
+                    self._logger.error("[%s] worker %d (pid %s) exited with %s, restarting", str(datetime.now()),
+                                       i, w.pid(), w.exitcode())
+                    w.stop()
+                    self._workers[i] = self._spawn(i)
+                    self._restarts += 1
+
+
+
+class Worker:
+    def __init__(self, index, cfg, dispatched, queue_size):
+        self._index = index
+        self._lock = Lock()
+        self._conn, child = multiprocessing.Pipe()
+        self._queue = multiprocessing.Queue(int(queue_size)) if dispatched else None
+        self._process = multiprocessing.Process(target=_run_worker, name="bt-mqtt-{0}".format(index),
+                                                args=(cfg, child, self._queue))
+        self._process.daemon = True
+
+
+    def start(self):
+        self._process.start()
+
+
+    def is_alive(self):
+        return self._process.is_alive()
+
+
+    def pid(self):
+        return self._process.pid
+
+
+    def exitcode(self):
+        return self._process.exitcode
+
+
+    # hand a message to the worker's process, False if its queue is full
+    def submit(self, topic, payload):
+        try:
+            self._queue.put_nowait((topic, payload))
+            return True
+        except Full:
+            return False
+
+
+    def status(self):
+        s = {"index": self._index, "pid": self.pid(), "alive": self.is_alive()}
+        stats = self.call("stats")
+        if stats is not None:
+            s['ingest'] = stats
+        return s
+
+
+    def stop(self, timeout=30):
+        if self.is_alive():
+            if self._queue is not None:
+                try:
+                    self._queue.put(_STOP, True, timeout)
+                except Full:
+                    pass
+            if self.call("stop", timeout) is None:
+                self._process.terminate()
+        self._process.join(timeout)
+
+
+    # send a command to the worker and wait for its reply, None if there is none
+    def call(self, command, timeout=2):
+        with self._lock:
+            if not self.is_alive():
+                return None
+            try:
+                self._conn.send(command)
+                if self._conn.poll(timeout):
+                    return self._conn.recv()
+            except (EOFError, IOError):
+                pass
+            return None
+
+
+
+# worker process: a complete MqttListener, fed from the dispatcher queue if there is one
+def _run_worker(cfg, conn, queue):
+    logger = logging.getLogger(__name__)
+    listener = MqttListener()
+    if not listener.reload_configuration(cfg, connect=queue is None) or not listener.start():
+        logger.error("[%s] worker %d failed to start", str(datetime.now()), os.getpid())
+        return
+
+    if queue is not None:
+        feeder = Thread(target=_feed, args=(listener, queue))
+        feeder.daemon = True
+        feeder.start()
+
+    while True:
+        try:
+            command = conn.recv()
+        except EOFError:
+            command = "stop"
+        if command == "stats":
+            conn.send(listener.ingest_stats())
+        elif command == "stop":
+            if queue is not None:
+                feeder.join(10)
+            listener.stop()
+            try:
+                conn.send(True)
+            except IOError:
+                pass
+            return
+        elif command[0] == "beacon":
+            conn.send(listener.beacon_state(command[1]))
+        elif command[0] == "receiver":
+            conn.send(listener.receiver_state(command[1]))
+
+
+def _feed(listener, queue):
+    while True:
+        try:
+            item = queue.get()
+        except (EOFError, IOError):
+            return
+        if item is _STOP:
+            return
+        listener.submit(item[0], item[1])
@@ -0,0 +1,111 @@
+import time
+from threading import Lock
+from collections import OrderedDict
+
+'''
+' Latest detection per beacon@receiver and latest status per receiver, kept in memory
+'
+' Entries are kept in least recently updated order. Past max_entries the least
+' recently updated ones are evicted, and entries older than max_age seconds are
+' pruned as newer ones arrive and skipped when read. Each beacon and each receiver
+' also has a small index of its live entries, so a read only touches that beacon's
+' or receiver's own detections.
+'''
+
+
+class LiveState:
+    def __init__(self, max_entries=10000, max_age=600, max_receivers=1000):
+        self._max_entries = int(max_entries)
+        self._max_age = float(max_age)
+        self._max_receivers = int(max_receivers)
+        self._lock = Lock()
+        self._detections = OrderedDict()
+        self._by_beacon = {}
+        self._by_receiver = {}
+        self._status = OrderedDict()
+        self._evicted = 0
+
+
+    def detection(self, beacon, receiver, rssi, timestamp):
+        now = time.time()
+        key = (beacon, receiver)
+        with self._lock:
+            entry = self._detections.pop(key, None)
+            if entry is None:
+                entry = {"beacon": beacon, "receiver": receiver}
+                self._by_beacon.setdefault(beacon, {})[receiver] = entry
+                self._by_receiver.setdefault(receiver, {})[beacon] = entry
+            entry['rssi'] = rssi
+            entry['timestamp'] = timestamp
+            entry['updated'] = now
+            self._detections[key] = entry
+            self._prune(now)
+
+
+    def status(self, receiver, status):
+        with self._lock:
+            self._status.pop(receiver, None)
+            self._status[receiver] = {"status": status, "updated": time.time()}
+            while len(self._status) > self._max_receivers:
+                self._status.popitem(last=False)
+
+
+    # receivers that heard the beacon recently, strongest first, None if there are none
+    def beacon(self, beacon):
+        now = time.time()
+        with self._lock:
+            entries = [ dict(e) for e in self._by_beacon.get(beacon, {}).values()
+                        if now - e['updated'] <= self._max_age ]
+        if not entries:
+            return None
+        entries.sort(key=lambda e: e['rssi'], reverse=True)
+        for e in entries:
+            e['age'] = now - e.pop('updated')
+            del e['beacon']
+        return {"beacon": beacon, "nearest": entries[0]['receiver'], "receivers": entries}
+
+
+    # last status of the receiver and the beacons it heard recently, None if unknown
+    def receiver(self, receiver):
+        now = time.time()
+        with self._lock:
+            status = self._status.get(receiver)
+            entries = [ dict(e) for e in self._by_receiver.get(receiver, {}).values()
+                        if now - e['updated'] <= self._max_age ]
+        if status is None and not entries:
+            return None
+        for e in entries:
+            e['age'] = now - e.pop('updated')
+            del e['receiver']
+        s = {"receiver": receiver, "beacons": entries}
+        if status is not None:
+            s['status'] = status['status']
+            s['status_age'] = now - status['updated']
+        return s
+
+
+    def stats(self):
+        return {"detections": len(self._detections),
+                "beacons": len(self._by_beacon),
+                "receivers": len(self._status),
+                "evicted": self._evicted}
+
+
+    # evict past max_entries, then anything older than max_age, oldest first
+    def _prune(self, now):
+        while self._detections:
+            key, entry = next(self._detections.iteritems())
+            if len(self._detections) <= self._max_entries and now - entry['updated'] <= self._max_age:
+                return
+            del self._detections[key]
+            self._remove(self._by_beacon, key[0], key[1])
+            self._remove(self._by_receiver, key[1], key[0])
+            self._evicted += 1
+
+
+    def _remove(self, index, outer, inner):
+        d = index.get(outer)
+        if d is not None:
+            d.pop(inner, None)
+            if not d:
+                del index[outer]
@@ -0,0 +1,169 @@
+import time
+import logging
+import numpy as np
+from threading import Thread, Event, Lock
+from datetime import datetime
+
+'''
+' Beacon location from the latest RSSI of every beacon at every receiver
+'
+' Detections update one cell of a beacons x receivers RSSI matrix, with the time the
+' cell was last seen kept in a matching matrix. Every interval seconds one vectorized
+' pass over the matrices finds, for each beacon updated since the previous tick, the
+' receiver with the strongest RSSI among cells younger than max_age, and optionally a
+' weighted centroid of the receivers' positions (weights are the RSSI as linear power,
+' so the nearest receivers dominate). One location update per beacon is then handed
+' to the poster, instead of one detection row per receiver.
+'
+' A beacon is marked as updated when its detection is handled rather than by the
+' detection's time, so one that waited in the ingest queue past a tick is still
+' located at the next one.
+'
+' Rows and columns are added as new beacons and receivers show up; the matrices grow
+' by doubling so adding one is rarely a copy.
+'''
+
+
+class LocationEngine(Thread):
+    def __init__(self, poster, interval=1.0, max_age=10.0, positions=None):
+        Thread.__init__(self)
+        self.daemon = True
+        self._poster = poster
+        self._interval = float(interval)
+        self._max_age = float(max_age)
+        self._positions = positions if positions is not None else {}
+        self._lock = Lock()
+        self._stop_event = Event()
+        self._beacons = {}
+        self._receivers = {}
+        self._beacon_nids = []
+        self._receiver_nids = []
+        self._rssi = np.zeros((16, 16))
+        self._seen = np.zeros((16, 16))
+        self._coords = np.full((16, 2), np.nan)
+        self._updated = np.zeros(16, dtype=bool)
+        self._ticks = 0
+        self._published = 0
+        self._tick_time = 0.0
+        self._logger = logging.getLogger(__name__)
+
+
+    # record the RSSI of a beacon at a receiver, receiver is its title for the position lookup
+    def update(self, beacon_nid, receiver, receiver_nid, rssi, seen=None):
+        with self._lock:
+            row = self._beacons.get(beacon_nid)
+            if row is None:
+                row = self._add_beacon(beacon_nid)
+            col = self._receivers.get(receiver_nid)
+            if col is None:
+                col = self._add_receiver(receiver, receiver_nid)
+            self._rssi[row, col] = rssi
+            self._seen[row, col] = time.time() if seen is None else seen
+            self._updated[row] = True
+
+
+    def stats(self):
+        return {"beacons": len(self._beacon_nids),
+                "receivers": len(self._receiver_nids),
+                "ticks": self._ticks,
+                "published": self._published,
+                "tick_ms": self._tick_time * 1000}
+
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            try:
+                self.tick()
+            except Exception as e:
+                self._logger.error("[%s] location tick failed: %s", str(datetime.now()), e, exc_info=True)
+
+
+    # compute and post the location of every beacon updated since the last tick
+    def tick(self, now=None):
+        now = time.time() if now is None else now
+        start = time.time()
+        with self._lock:
+            n, m = len(self._beacon_nids), len(self._receiver_nids)
+            rssi = self._rssi[:n, :m].copy()
+            seen = self._seen[:n, :m].copy()
+            updated = self._updated[:n].copy()
+            self._updated[:n] = False
+            coords = self._coords[:m].copy()
+            beacon_nids = self._beacon_nids[:]
+            receiver_nids = self._receiver_nids[:]
+        if n == 0 or m == 0:
+            return 0
+
+        valid = (seen > 0) & (now - seen <= self._max_age)
+        fresh = np.flatnonzero(updated & valid.any(axis=1))
+        if len(fresh) == 0:
+            return 0
+        rssi, valid, seen = rssi[fresh], valid[fresh], seen[fresh]
+
+        nearest = np.where(valid, rssi, -np.inf).argmax(axis=1)
+        strongest = rssi[np.arange(len(fresh)), nearest]
+        latest = np.where(valid, seen, 0).max(axis=1)
+
+        located = np.isfinite(coords).all(axis=1)
+        if located.any():
+            weights = np.where(valid & located, np.power(10.0, rssi / 10.0), 0.0)
+            total = weights.sum(axis=1)
+            xy = weights.dot(np.where(located[:, None], coords, 0.0)) / np.where(total > 0, total, 1.0)[:, None]
+        else:
+            total = np.zeros(len(fresh))
+
+        for i, row in enumerate(fresh):
+            values = {
+                'field_receiver': receiver_nids[nearest[i]],
+                'field_rssi': float(strongest[i]),
+                'field_receivers': int(valid[i].sum()),
+                'field_timestamp': int(latest[i])
+            }
+            if total[i] > 0:
+                values['field_x'] = float(xy[i, 0])
+                values['field_y'] = float(xy[i, 1])
+            self._poster.add({"keys": {'field_beacon': beacon_nids[row]}, "values": values})
+
+        self._ticks += 1
+        self._published += len(fresh)
+        self._tick_time = time.time() - start
+        return len(fresh)
+
+
+    def _add_beacon(self, nid):
+        row = len(self._beacon_nids)
+        if row == self._rssi.shape[0]:
+            self._rssi = _grow(self._rssi, 0, 0.0)
+            self._seen = _grow(self._seen, 0, 0.0)
+            self._updated = _grow(self._updated, 0, False)
+        self._beacons[nid] = row
+        self._beacon_nids.append(nid)
+        return row
+
+
+    def _add_receiver(self, title, nid):
+        col = len(self._receiver_nids)
+        if col == self._rssi.shape[1]:
+            self._rssi = _grow(self._rssi, 1, 0.0)
+            self._seen = _grow(self._seen, 1, 0.0)
+            self._coords = _grow(self._coords, 0, np.nan)
+        if title in self._positions:
+            self._coords[col] = self._positions[title][:2]
+        self._receivers[nid] = col
+        self._receiver_nids.append(nid)
+        return col
+
+
+
+# double an array along axis, filling the new part with fill
+def _grow(a, axis, fill):
+    shape = list(a.shape)
+    shape[axis] *= 2
+    b = np.full(shape, fill)
+    b[tuple(slice(0, s) for s in a.shape)] = a
+    return b
@@ -0,0 +1,75 @@
+import gzip
+import struct
+import time
+from threading import Lock
+
+'''
+' Capture file of MQTT traffic, written by mqtt-capture.py and read by mqtt-replay.py
+'
+' A capture is an 8 byte header (magic "BTMC" and a version) followed by one record per
+' message: arrival time as a double, topic length (2 bytes), payload length (4 bytes),
+' then the topic and payload bytes. Payloads are stored exactly as received. With
+' compress the whole file is gzip'ed, which shrinks the repetitive JSON of value
+' messages several times over; read_capture() detects it from the gzip magic.
+'''
+
+_MAGIC = 'BTMC'
+_VERSION = 1
+_HEADER = struct.Struct('<4sI')
+_RECORD = struct.Struct('<dHI')
+
+
+class CaptureWriter:
+    def __init__(self, filename, compress=False):
+        self._fp = gzip.open(filename, 'wb') if compress else open(filename, 'wb')
+        self._fp.write(_HEADER.pack(_MAGIC, _VERSION))
+        self._lock = Lock()
+        self._messages = 0
+        self._bytes = 0
+
+
+    def write(self, topic, payload, arrival=None):
+        arrival = time.time() if arrival is None else arrival
+        if isinstance(topic, unicode):
+            topic = topic.encode('utf-8')
+        record = _RECORD.pack(arrival, len(topic), len(payload)) + topic + payload
+        with self._lock:
+            self._fp.write(record)
+            self._messages += 1
+            self._bytes += len(record)
+
+
+    def stats(self):
+        return {"messages": self._messages, "bytes": self._bytes}
+
+
+    def close(self):
+        with self._lock:
+            self._fp.close()
+
+
+
+# yield (arrival, topic, payload) for every complete record in a capture file
+def read_capture(filename):
+    with open(filename, 'rb') as raw:
+        compressed = raw.read(2) == '\x1f\x8b'
+    fp = gzip.open(filename, 'rb') if compressed else open(filename, 'rb')
+    try:
+        magic, version = _HEADER.unpack(fp.read(_HEADER.size))
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("{0} is not a capture file".format(filename))
+        while True:
+            # a capture cut short, eg: by killing the recorder, ends at its last whole record
+            try:
+                header = fp.read(_RECORD.size)
+                if len(header) < _RECORD.size:
+                    return
+                arrival, topic_length, payload_length = _RECORD.unpack(header)
+                data = fp.read(topic_length + payload_length)
+            except (IOError, EOFError):
+                return
+            if len(data) < topic_length + payload_length:
+                return
+            yield arrival, data[:topic_length], data[topic_length:]
+    finally:
+        fp.close()
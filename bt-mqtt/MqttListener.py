@@ -4,10 +4,13 @@ import json
 import time
 import logging
 from datetime import datetime
-from urllib import urlopen
-from dateutil import parser
-import calendar
 import re
+from DetectionPoster import DetectionPoster
+from RestSession import create_session
+from IngestPipeline import IngestPipeline
+from ObjectIndex import ObjectIndex
+from PayloadDecoder import TimestampParser, decode_value_message
+from LiveState import LiveState
 
 ''' 
 ' Configuration Items
@@ -16,9 +19,44 @@ import re
 ' "keepalive"       - seconds for keepalive on connect
 ' "topic"           - MQTT topic to subscribe to (eg: sdw/#)
 ' "object_endpoint" - WS endpoint for node-content-rest (eg: http://(lamp)/rest)
+'
+' Optional items
+'
+' "detection_flush_size"  - detections buffered before a bulk post (default 50, 1 posts each one)
+' "detection_max_latency" - max seconds a detection waits in the buffer (default 2)
+' "detection_retries"     - attempts for a failed bulk post before it is dropped (default 3),
+'                           the only retries for detection posts; rest_retries doesn't apply
+' "detection_coalesce"    - seconds detections of the same beacon@receiver are merged, keeping
+'                           the newest, before posting; replaces detection_max_latency (default 0, off)
+' "detection_max_pending" - detections buffered at most, the oldest are dropped beyond it (default 10000)
+' "rest_pool_size", "rest_connect_timeout", "rest_read_timeout", "rest_retries", "rest_backoff"
+'                         - REST connection pooling, timeouts and retries, see RestSession
+' "ingest_queue_size"     - messages buffered between MQTT receive and processing (default 1000)
+' "ingest_workers"        - worker threads processing messages, caps concurrent REST calls (default 4);
+'                           each topic path is always handled by the same worker, in arrival order
+' "ingest_overflow"       - drop_oldest or drop_newest when the ingest queue is full (default drop_oldest)
+' "index_refresh_interval"    - seconds before the beacon/receiver index is reloaded (default 300)
+' "index_negative_ttl"        - seconds an unknown beacon/receiver is remembered as unknown (default 60)
+' "index_min_reload_interval" - min seconds between reloads caused by unknown names (default 5)
+' "location_enabled"      - run the LocationEngine, needs NumPy (default false)
+' "location_interval"     - seconds between location updates (default 1)
+' "location_max_age"      - seconds an RSSI reading counts towards a location (default 10)
+' "location_positions"    - receiver title to [x, y], enables the weighted centroid
+' "location_resource"     - REST resource location updates are posted to (default /bt_beacon_location)
+' "location_detections"   - also post every detection row when locating (default true)
+' "live_max_entries"      - beacon@receiver detections kept in memory for /beacons and /receivers (default 10000)
+' "live_max_age"          - seconds a detection stays in the in-memory live state (default 600)
 '''
 
 
+# host and port from a "server" item like tcp://host:1883, port defaults to 1883
+def parse_server(server, port=None):
+    m = re.match('([a-z]*://)?([^:/]+)?:?([0-9]+)?', server)
+    if m.group(3):
+        port = int(m.group(3))
+    return m.group(2), 1883 if port is None else int(port)
+
+
 class MqttListener:
     def __init__(self):
         self._cfg = None
@@ -26,42 +64,66 @@ class MqttListener:
         self._ready_to_run = False
         self._running = False
         self._subscribed_to = None
-        self._beacons = {}
-        self._receivers = {}
+        self._beacons = None
+        self._receivers = None
         self._last_error = None
+        self._poster = None
+        self._session = None
+        self._post_session = None
+        self._pipeline = None
+        self._locator = None
+        self._location_poster = None
+        self._live = None
+        self._timestamps = TimestampParser()
         self._logger = logging.getLogger(__name__)
 
-    def reload_configuration(self, config):
+    # connect=False leaves out the MQTT client, messages are then fed in with submit()
+    def reload_configuration(self, config, connect=True):
         self._cfg = config
-        m = re.match('([a-z]*://)?([^:/]+)?:?([0-9]+)?', self._cfg['server'])
-        self._cfg['port'] = 1883 if m.group(3) == '' else int(m.group(3))
-        self._cfg['server'] = m.group(2)
+        self._cfg['server'], self._cfg['port'] = parse_server(self._cfg['server'], self._cfg.get('port'))
         self._ready_to_run = False
-        self._client = mqtt.Client()
-        self._client.on_connect = self.on_connect
-        self._client.on_message = self.on_message
-        self._client.connect(self._cfg['server'], int(self._cfg['port']), int(self._cfg['keepalive']))
+        if self._session is not None:
+            self._session.close()
+            self._post_session.close()
+        self._session = create_session(self._cfg)
+        # the detection posters do their own retries, see RestSession
+        self._post_session = create_session(self._cfg, retries=0)
+        self._live = LiveState(self._cfg.get('live_max_entries', 10000), self._cfg.get('live_max_age', 600))
+        self._client = None
+        if connect:
+            self._client = mqtt.Client()
+            self._client.on_connect = self.on_connect
+            self._client.on_message = self.on_message
+            self._client.connect(self._cfg['server'], int(self._cfg['port']), int(self._cfg['keepalive']))
 
-        self._beacons = self.load_objects('bt_beacon', 'title', ['nid'])
-        if self._beacons is None:
+        self._beacons = self.create_index('bt_beacon')
+        if not self._beacons.load():
             return False
         else:
-            self._logger.info("[%s] loaded beacons [%s]", str(datetime.now()),
-                              reduce(lambda x,y: "{0} {1}".format(x,y), [z for z in self._beacons]))
+            self._logger.info("[%s] loaded beacons [%s]", str(datetime.now()), " ".join(self._beacons.keys()))
 
-        self._receivers = self.load_objects('bt_receiver', 'title', ['nid'])
-        if self._receivers is None:
+        self._receivers = self.create_index('bt_receiver')
+        if not self._receivers.load():
             return False
         else:
-            self._logger.info("[%s] loaded receivers [%s]", str(datetime.now()),
-                              reduce(lambda x,y: "{0} {1}".format(x,y), [z for z in self._receivers]))
+            self._logger.info("[%s] loaded receivers [%s]", str(datetime.now()), " ".join(self._receivers.keys()))
 
         self._ready_to_run = True
         return True
     
     def stop(self):
         if self._running:
-            self._client.loop_stop()
+            if self._client is not None:
+                self._client.loop_stop()
+            self._pipeline.stop()
+            self._pipeline = None
+            if self._locator is not None:
+                self._locator.stop()
+                self._locator = None
+                self._location_poster.stop()
+                self._location_poster = None
+            self._poster.stop()
+            self._poster = None
             self._running = False
             self._logger.info("[%s] MQTT listener stopped", str(datetime.now()))
         else:
@@ -78,10 +140,42 @@ class MqttListener:
             return False
         
         self._logger.info("[%s] starting listener", str(datetime.now()))
-        self._client.loop_start()
+        self._poster = DetectionPoster(self._post_session, "/bt_beacon_detection",
+                                       flush_size=self._cfg.get('detection_flush_size', 50),
+                                       max_latency=self._cfg.get('detection_max_latency', 2),
+                                       retries=self._cfg.get('detection_retries', 3),
+                                       coalesce=self._cfg.get('detection_coalesce', 0),
+                                       max_pending=self._cfg.get('detection_max_pending', 10000))
+        self._poster.start()
+        if self._cfg.get('location_enabled', False):
+            self.start_location()
+        self._pipeline = IngestPipeline(self.handle_message,
+                                        queue_size=self._cfg.get('ingest_queue_size', 1000),
+                                        workers=self._cfg.get('ingest_workers', 4),
+                                        overflow=self._cfg.get('ingest_overflow', 'drop_oldest'))
+        self._pipeline.start()
+        if self._client is not None:
+            self._client.loop_start()
+        self._running = True
         return True
 
 
+    # NumPy is only imported when locating is enabled
+    def start_location(self):
+        from LocationEngine import LocationEngine
+        self._location_poster = DetectionPoster(self._post_session, self._cfg.get('location_resource', "/bt_beacon_location"),
+                                                flush_size=self._cfg.get('detection_flush_size', 50),
+                                                max_latency=self._cfg.get('detection_max_latency', 2),
+                                                retries=self._cfg.get('detection_retries', 3),
+                                                max_pending=self._cfg.get('detection_max_pending', 10000))
+        self._location_poster.start()
+        self._locator = LocationEngine(self._location_poster,
+                                       interval=self._cfg.get('location_interval', 1),
+                                       max_age=self._cfg.get('location_max_age', 10),
+                                       positions=self._cfg.get('location_positions'))
+        self._locator.start()
+
+
     def on_connect(self, client, userdata, flags, rc):
         print("Connected with result code "+str(rc))
         code = {0: "Connection successful",
@@ -99,31 +193,78 @@ class MqttListener:
             self._logger.error(self._last_error)
 
 
+    # runs on the paho network thread, so only hand the message to the pipeline
     def on_message(self, client, userdata, msg):
-        if 'value' in msg.topic:
-            o = json.loads(msg.payload)
-            unix_time = calendar.timegm(parser.parse(o['datetime']).timetuple())
+        self._pipeline.submit(msg.topic, msg.payload)
+
+
+    # queue a message received some other way, eg: from a ListenerGroup dispatcher
+    def submit(self, topic, payload):
+        return self._pipeline.submit(topic, payload)
+
+
+    # current ingest queue and poster counters
+    def ingest_stats(self):
+        stats = {}
+        if self._pipeline is not None:
+            stats['queue'] = self._pipeline.stats()
+        if self._poster is not None:
+            stats['poster'] = self._poster.stats()
+        if self._beacons is not None:
+            stats['beacons'] = self._beacons.stats()
+        if self._receivers is not None:
+            stats['receivers'] = self._receivers.stats()
+        if self._locator is not None:
+            stats['location'] = self._locator.stats()
+            stats['location_poster'] = self._location_poster.stats()
+        if self._live is not None:
+            stats['live'] = self._live.stats()
+        stats['timestamps'] = self._timestamps.stats()
+        return stats
+
+
+    # latest detections of a beacon by title, None if it wasn't heard recently
+    def beacon_state(self, beacon):
+        return None if self._live is None else self._live.beacon(beacon)
+
+
+    # latest status of a receiver by title and the beacons it heard, None if unknown
+    def receiver_state(self, receiver):
+        return None if self._live is None else self._live.receiver(receiver)
+
+
+    # process one message, called from the ingest pipeline's worker threads
+    # value messages may carry one beacon or, from receivers publishing in batch mode,
+    # every beacon of a window (per path or per receiver); each value has its own
+    # beacon and receiver attributes
+    def handle_message(self, topic, payload, arrival):
+        if 'value' in topic:
+            o, unix_time = decode_value_message(payload, self._timestamps)
             for v in o['values']:
                 if 'beacon' in v['attributes'] and 'receiver' in v['attributes']:
                     beacon = v['attributes']['beacon']
                     receiver = v['attributes']['receiver']
 
-                    if beacon not in self._beacons:
-                        self._beacons = load_objects('bt_beacon', 'title', ['nid'])
-                        if beacon not in self._beacons:
-                            self._logger.info("[%s] Beacon %s not found, skipping", str(datetime.now()), beacon)
-                            continue
+                    b = self._beacons.lookup(beacon)
+                    if b is None:
+                        self._logger.debug("[%s] Beacon %s not found, skipping", str(datetime.now()), beacon)
+                        continue
 
-                    if receiver not in self._receivers:
-                        self._receivers = load_objects('bt_receiver', 'title', ['nid'])
-                        if receiver not in self._receiver:
-                            self._logger.info("[%s] Receiver %s not found, skipping", str(datetime.now()), receiver)
-                            continue
+                    r = self._receivers.lookup(receiver)
+                    if r is None:
+                        self._logger.debug("[%s] Receiver %s not found, skipping", str(datetime.now()), receiver)
+                        continue
                             
+                    self._live.detection(beacon, receiver, v['amount'], unix_time)
+                    if self._locator is not None:
+                        self._locator.update(b['nid'], receiver, r['nid'], v['amount'], arrival)
+                        if not self._cfg.get('location_detections', True):
+                            continue
+
                     update = {
                         "keys": {
-                            'field_beacon': self._beacons[beacon]['nid'],
-                            'field_receiver': self._receivers[receiver]['nid'],
+                            'field_beacon': b['nid'],
+                            'field_receiver': r['nid'],
                             'field_detection_mode': 'live'
                         },
                         "values": {
@@ -132,28 +273,45 @@ class MqttListener:
                             'field_timestamp': unix_time
                         }
                     }
-                    fp = urlopen(self._cfg['object_endpoint'] + "/bt_beacon_detection", data="json="+json.dumps(update))
-                    self._logger.info("[%s] Data post results: %s", str(datetime.now()), fp.read())
+                    self._poster.add(update)
                 else:
-                    self._logger.info("[%s] Missing needed attributes: %s", str(datetime.now()), o)
-        elif 'status' in msg.topic:
-            o = json.loads(msg.payload)
+                    self._logger.info("[%s] Missing needed attributes: %s", str(datetime.now()), v)
+        elif 'status' in topic:
+            o = json.loads(payload)
             if 'attributes' not in o:
-                self._logger.info("[%s] No attribute in payload: %s", str(datetime.now()), msg.payload)
+                self._logger.info("[%s] No attribute in payload: %s", str(datetime.now()), payload)
             elif 'receiver' in o['attributes']:
                 receiver = o['attributes']['receiver']
+                r = self._receivers.lookup(receiver)
+                if r is None:
+                    self._logger.info("[%s] Receiver %s not found, skipping status", str(datetime.now()), receiver)
+                    return
+                self._live.status(receiver, o['status'])
                 update = {
                     "keys": {
-                        'nid': self._receivers[receiver]['nid']
+                        'nid': r['nid']
                     },
                     "values": {
                         'field_receiver_status': o['status']
                     }
                 }
-                fp = urlopen(self._cfg['object_endpoint'] + "/bt_receiver", data="json="+json.dumps(update))
-                self._logger.info("[%s] Status post results: %s", str(datetime.now()), fp.read())
+                try:
+                    r = self._session.post("/bt_receiver", update)
+                    self._logger.info("[%s] Status post results: %s", str(datetime.now()), r.text)
+                except requests.RequestException as e:
+                    self._logger.error("[%s] Status post failed: %s", str(datetime.now()), e)
         else:
-            self._logger.info("[%s] Missing needed attributes: %s", str(datetime.now()), o)
+            self._logger.info("[%s] Unrecognized topic: %s", str(datetime.now()), topic)
+
+
+    #
+    # Create a cached index of a content type keyed by title
+    #
+    def create_index(self, content_type):
+        return ObjectIndex(lambda: self.load_objects(content_type, 'title', ['nid']),
+                           refresh_interval=self._cfg.get('index_refresh_interval', 300),
+                           negative_ttl=self._cfg.get('index_negative_ttl', 60),
+                           min_reload_interval=self._cfg.get('index_min_reload_interval', 5))
 
 
     #
@@ -161,7 +319,12 @@ class MqttListener:
     #
     def load_objects(self, content_type, key, fields):
         index = {}
-        r = requests.get(self._cfg['object_endpoint'] + '/query/' + content_type)
+        try:
+            r = self._session.get('/query/' + content_type)
+        except requests.RequestException as e:
+            self._last_error = "[{0}] Error building object index [{1}]: {2}".format(str(datetime.now()), content_type, e)
+            self._logger.error(self._last_error)
+            return None
         if r.ok:
             for o in r.json():
                 obj = {}
@@ -0,0 +1,104 @@
+import time
+import logging
+from threading import Lock
+from datetime import datetime
+
+'''
+' Cached index of REST objects (beacons or receivers) keyed by title
+'
+' The index is reloaded through the loader function when it is older than
+' refresh_interval seconds, or when a lookup misses. Miss-driven reloads are
+' limited to one every min_reload_interval seconds, and keys still missing after a
+' reload go into a negative cache for negative_ttl seconds, so unregistered
+' beacons do not cause repeated downloads. Reloads are single-flight: threads that
+' miss while a reload is in progress wait for it and share its result.
+'''
+
+
+class ObjectIndex:
+    def __init__(self, loader, refresh_interval=300, negative_ttl=60, min_reload_interval=5, max_negative=10000):
+        self._loader = loader
+        self._refresh_interval = float(refresh_interval)
+        self._negative_ttl = float(negative_ttl)
+        self._min_reload_interval = float(min_reload_interval)
+        self._max_negative = int(max_negative)
+        self._index = {}
+        self._negative = {}
+        self._loaded_at = None
+        self._generation = 0
+        self._load_lock = Lock()
+        self._reloads = 0
+        self._negative_hits = 0
+        self._logger = logging.getLogger(__name__)
+
+
+    # force a reload of the index, returns False if the loader failed
+    def load(self):
+        return self._reload(self._generation)
+
+
+    # return the object for key, or None if it isn't known
+    def lookup(self, key):
+        generation = self._generation
+        if self._loaded_at is None or time.time() - self._loaded_at > self._refresh_interval:
+            self._reload(generation)
+            generation = self._generation
+
+        obj = self._index.get(key)
+        if obj is not None:
+            return obj
+
+        expiry = self._negative.get(key)
+        now = time.time()
+        if expiry is not None and expiry > now:
+            self._negative_hits += 1
+            return None
+
+        if self._loaded_at is None or now - self._loaded_at >= self._min_reload_interval:
+            self._reload(generation)
+            obj = self._index.get(key)
+            if obj is not None:
+                return obj
+
+        self._remember_missing(key)
+        return None
+
+
+    def keys(self):
+        return self._index.keys()
+
+
+    def stats(self):
+        return {"size": len(self._index),
+                "negative": len(self._negative),
+                "reloads": self._reloads,
+                "negative_hits": self._negative_hits}
+
+
+    # reload unless another thread already did since generation was read
+    def _reload(self, generation):
+        with self._load_lock:
+            if self._generation != generation:
+                return self._loaded_at is not None
+            index = self._loader()
+            self._loaded_at = time.time()
+            self._generation += 1
+            self._reloads += 1
+            if index is None:
+                return False
+            self._index = index
+            for k in [k for k in self._negative if k in index]:
+                del self._negative[k]
+            return True
+
+
+    def _remember_missing(self, key):
+        with self._load_lock:
+            now = time.time()
+            if len(self._negative) >= self._max_negative:
+                self._negative = dict((k, v) for k, v in self._negative.iteritems() if v > now)
+                if len(self._negative) >= self._max_negative:
+                    self._logger.warning("[%s] negative cache full, clearing %d entries",
+                                         str(datetime.now()), len(self._negative))
+                    self._negative = {}
+            self._negative[key] = now + self._negative_ttl
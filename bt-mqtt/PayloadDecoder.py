@@ -0,0 +1,59 @@
+import re
+import json
+import calendar
+from dateutil import parser
+
+'''
+' Decoding of MQTT payloads and their timestamps
+'
+' TimestampParser converts the message "datetime" to unix time. Strict ISO-8601
+' strings (what SA publishes) are parsed with a regular expression; anything else
+' falls back to dateutil. Results are memoized since many values and receivers
+' share the same datetime. Both paths give the same result as the original
+' calendar.timegm(parser.parse(s).timetuple()): the wall clock fields are taken as
+' UTC and fractional seconds are dropped.
+'''
+
+_ISO_8601 = re.compile(r'^(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:[.,]\d+)?(?:Z|[+-]\d\d(?::?\d\d)?)?$')
+
+
+class TimestampParser:
+    def __init__(self, cache_size=4096):
+        self._cache_size = int(cache_size)
+        self._cache = {}
+        self._fast = 0
+        self._fallback = 0
+        self._hits = 0
+
+
+    # unix time for a datetime string
+    def parse(self, s):
+        t = self._cache.get(s)
+        if t is not None:
+            self._hits += 1
+            return t
+
+        m = _ISO_8601.match(s)
+        if m is not None:
+            self._fast += 1
+            t = calendar.timegm(tuple(int(x) for x in m.groups()))
+        else:
+            self._fallback += 1
+            t = calendar.timegm(parser.parse(s).timetuple())
+
+        if len(self._cache) >= self._cache_size:
+            self._cache = {}
+        self._cache[s] = t
+        return t
+
+
+    def stats(self):
+        return {"fast": self._fast,
+                "fallback": self._fallback,
+                "hits": self._hits}
+
+
+# decode a value message, returning the parsed payload and its unix time
+def decode_value_message(payload, timestamps):
+    o = json.loads(payload)
+    return o, timestamps.parse(o['datetime'])
@@ -0,0 +1,73 @@
+import json
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    from requests.packages.urllib3.util.retry import Retry
+
+'''
+' Pooled, keep-alive session for the node-content-rest endpoint
+'
+' All REST traffic from the listener goes through one RestSession so connections are
+' reused instead of opening a new TCP connection per post. Every request has a
+' connect and read timeout, and connection errors and 502/503/504 responses are
+' retried with exponential backoff. Upserts are keyed, so POSTs are safe to retry.
+'
+' Detection posts are the exception: DetectionPoster retries a failed bulk post
+' itself ("detection_retries"), so the listener gives the posters their own session
+' with rest_retries of 0. Retrying in both layers multiplied the attempts and could
+' hold up the poster thread for minutes on one bad chunk.
+'
+' Configuration items (all optional)
+'
+' "rest_pool_size"       - max pooled connections to the endpoint (default 4)
+' "rest_connect_timeout" - seconds to wait for a connection (default 3.05)
+' "rest_read_timeout"    - seconds to wait for a response (default 10)
+' "rest_retries"         - retries for failed requests, other than detection posts (default 3)
+' "rest_backoff"         - backoff factor in seconds between retries (default 0.5)
+'''
+
+
+class RestSession:
+    def __init__(self, endpoint, pool_size=4, connect_timeout=3.05, read_timeout=10, retries=3, backoff=0.5):
+        self._endpoint = endpoint.rstrip('/')
+        self._timeout = (float(connect_timeout), float(read_timeout))
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=int(pool_size),
+                              max_retries=self._create_retry(int(retries), float(backoff)))
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+
+    # GET a resource relative to the endpoint, eg: /query/bt_beacon
+    def get(self, resource):
+        return self._session.get(self._endpoint + resource, timeout=self._timeout)
+
+
+    # POST an update to a resource relative to the endpoint, eg: /bt_receiver
+    def post(self, resource, update):
+        return self._session.post(self._endpoint + resource, data={"json": json.dumps(update)},
+                                  timeout=self._timeout)
+
+
+    def close(self):
+        self._session.close()
+
+
+    def _create_retry(self, retries, backoff):
+        args = {"total": retries, "backoff_factor": backoff, "status_forcelist": [502, 503, 504]}
+        try:
+            return Retry(allowed_methods=False, **args)
+        except TypeError:
+            return Retry(method_whitelist=False, **args)
+
+
+# build a session from the listener configuration, retries overrides "rest_retries"
+def create_session(cfg, retries=None):
+    return RestSession(cfg['object_endpoint'],
+                       pool_size=cfg.get('rest_pool_size', 4),
+                       connect_timeout=cfg.get('rest_connect_timeout', 3.05),
+                       read_timeout=cfg.get('rest_read_timeout', 10),
+                       retries=cfg.get('rest_retries', 3) if retries is None else retries,
+                       backoff=cfg.get('rest_backoff', 0.5))
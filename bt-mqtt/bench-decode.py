@@ -0,0 +1,61 @@
+import json
+import time
+import random
+import calendar
+import argparse
+from datetime import datetime, timedelta
+from dateutil import parser
+from PayloadDecoder import TimestampParser, decode_value_message
+
+'''
+' Micro-benchmark for value message decoding
+'
+' Compares the original decode (json.loads + dateutil + calendar.timegm) against
+' PayloadDecoder for generated value messages and prints messages/sec for each.
+'
+' Run with: python bench-decode.py -n 20000 -r 12 -b 50
+'''
+
+
+def create_messages(count, receivers, beacons):
+    start = datetime(2018, 1, 1)
+    messages = []
+    for i in range(count):
+        # receivers publish on the same window, so datetimes repeat across them
+        ts = (start + timedelta(seconds=i // receivers)).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        values = [{"amount": random.uniform(-90, -40),
+                   "attributes": {"beacon": "b{0}".format(b), "receiver": "r{0}".format(i % receivers)}}
+                  for b in range(beacons)]
+        messages.append(json.dumps({"datetime": ts, "values": values}))
+    return messages
+
+
+def original_decode(payload):
+    o = json.loads(payload)
+    return o, calendar.timegm(parser.parse(o['datetime']).timetuple())
+
+
+def run(name, decode, messages):
+    start = time.time()
+    for m in messages:
+        decode(m)
+    elapsed = time.time() - start
+    print "{0:<10} {1:>10.0f} msgs/sec".format(name, len(messages) / elapsed)
+    return elapsed
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="benchmark value message decoding")
+    ap.add_argument("-n", "--messages", type=int, default=20000)
+    ap.add_argument("-r", "--receivers", type=int, default=12)
+    ap.add_argument("-b", "--beacons", type=int, default=1)
+    args = ap.parse_args()
+
+    messages = create_messages(args.messages, args.receivers, args.beacons)
+    for m in messages[:10]:
+        assert original_decode(m)[1] == decode_value_message(m, TimestampParser())[1]
+
+    before = run("original", original_decode, messages)
+    timestamps = TimestampParser()
+    after = run("fast-path", lambda m: decode_value_message(m, timestamps), messages)
+    print "speedup    {0:>10.1f}x  {1}".format(before / after, timestamps.stats())
@@ -0,0 +1,290 @@
+import json
+import time
+import socket
+import struct
+import urlparse
+import argparse
+import logging
+from threading import Thread, Lock
+from SocketServer import ThreadingMixIn, ThreadingTCPServer, BaseRequestHandler
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from datetime import datetime
+import paho.mqtt.client as mqtt
+from MqttListener import MqttListener
+
+'''
+' End-to-end benchmark for MqttListener
+'
+' Stands up a minimal in-process MQTT 3.1.1 broker (QoS 0, enough for paho) and a fake
+' node-content-rest endpoint, then replays value and status traffic for N receivers x
+' M beacons through a real MqttListener. Every RSSI value is unique so the REST stand-in
+' can match each detection it receives to the time it was published.
+'
+' Reports sustained messages/sec, REST calls per message and p50/p99 latency from
+' publish to the REST post that carried it.
+'
+' Run with: python bench-listener.py -n 12 -m 80 -w 20 -i 0.5
+'
+' Listener options can be passed as JSON, eg: -o '{"detection_flush_size": 1}'
+'''
+
+
+class Broker(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), BrokerConnection)
+        self.lock = Lock()
+        self.subscriptions = []
+
+
+    def route(self, topic, packet):
+        with self.lock:
+            targets = [c for f, c in self.subscriptions if topic_matches(f, topic)]
+        for c in targets:
+            c.send(packet)
+
+
+    def drop(self, connection):
+        with self.lock:
+            self.subscriptions = [(f, c) for f, c in self.subscriptions if c is not connection]
+
+
+
+class BrokerConnection(BaseRequestHandler):
+    def setup(self):
+        self._send_lock = Lock()
+
+
+    def send(self, data):
+        with self._send_lock:
+            try:
+                self.request.sendall(data)
+            except socket.error:
+                pass
+
+
+    def handle(self):
+        fp = self.request.makefile('rb')
+        try:
+            while True:
+                header = fp.read(1)
+                if not header:
+                    return
+                kind = ord(header) >> 4
+                body = fp.read(read_length(fp))
+                if kind == 1:
+                    self.send('\x20\x02\x00\x00')
+                elif kind == 3:
+                    qos = (ord(header) >> 1) & 3
+                    n = struct.unpack('!H', body[:2])[0]
+                    topic = body[2:2 + n]
+                    rest = body[2 + n:]
+                    if qos:
+                        self.send('\x40\x02' + rest[:2])
+                        rest = rest[2:]
+                    self.server.route(topic, encode_publish(topic, rest))
+                elif kind == 8:
+                    pid, pos, granted = body[:2], 2, ''
+                    while pos < len(body):
+                        n = struct.unpack('!H', body[pos:pos + 2])[0]
+                        with self.server.lock:
+                            self.server.subscriptions.append((body[pos + 2:pos + 2 + n], self))
+                        pos += 3 + n
+                        granted += '\x00'
+                    self.send('\x90' + encode_length(2 + len(granted)) + pid + granted)
+                elif kind == 12:
+                    self.send('\xd0\x00')
+                elif kind == 14:
+                    return
+        finally:
+            self.server.drop(self)
+
+
+
+def read_length(fp):
+    length, shift = 0, 0
+    while True:
+        b = ord(fp.read(1))
+        length += (b & 0x7f) << shift
+        if b < 0x80:
+            return length
+        shift += 7
+
+
+def encode_length(n):
+    s = ''
+    while True:
+        b, n = n % 128, n // 128
+        s += chr(b | 0x80 if n else b)
+        if not n:
+            return s
+
+
+def encode_publish(topic, payload):
+    body = struct.pack('!H', len(topic)) + topic + payload
+    return '\x30' + encode_length(len(body)) + body
+
+
+def topic_matches(pattern, topic):
+    p, t = pattern.split('/'), topic.split('/')
+    for i, level in enumerate(p):
+        if level == '#':
+            return True
+        if i >= len(t) or (level != '+' and level != t[i]):
+            return False
+    return len(p) == len(t)
+
+
+
+class Rest(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, receivers, beacons):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), RestHandler)
+        self.lock = Lock()
+        self.objects = {"bt_beacon": [{"title": "B{0}".format(i), "nid": 1000 + i} for i in range(beacons)],
+                        "bt_receiver": [{"title": "R{0}".format(i), "nid": i} for i in range(receivers)]}
+        self.sent = {}
+        self.latencies = []
+        self.gets = 0
+        self.posts = 0
+        self.statuses = 0
+
+
+
+class RestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.gets += 1
+        self.reply(json.dumps(self.server.objects.get(self.path.split('/')[-1], [])))
+
+
+    def do_POST(self):
+        now = time.time()
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        update = json.loads(urlparse.parse_qs(body)['json'][0])
+        updates = update if isinstance(update, list) else [update]
+        with self.server.lock:
+            self.server.posts += 1
+            for u in updates:
+                sent = self.server.sent.pop(u['values'].get('field_rssi'), None)
+                if sent is not None:
+                    self.server.latencies.append(now - sent)
+                elif 'field_receiver_status' in u['values']:
+                    self.server.statuses += 1
+        self.reply('{"status":"ok"}')
+
+
+    def reply(self, text):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+
+    def log_message(self, *args):
+        pass
+
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def serve(server):
+    t = Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="end-to-end benchmark of MqttListener")
+    ap.add_argument("-n", "--receivers", type=int, default=12)
+    ap.add_argument("-m", "--beacons", type=int, default=80)
+    ap.add_argument("-w", "--windows", type=int, default=20, help="windows each receiver publishes")
+    ap.add_argument("-i", "--interval", type=float, default=0.5, help="seconds between windows, 0 for no pause")
+    ap.add_argument("--per-beacon", action="store_true", help="one message per beacon instead of one per receiver window")
+    ap.add_argument("-o", "--options", default="{}", help="extra listener configuration as JSON")
+    ap.add_argument("-t", "--timeout", type=float, default=30, help="seconds to wait for the listener to drain")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    broker = Broker()
+    rest = Rest(args.receivers, args.beacons)
+    serve(broker)
+    serve(rest)
+
+    cfg = {"server": "tcp://127.0.0.1:{0}".format(broker.server_address[1]), "keepalive": 60, "topic": "sdw/#",
+           "object_endpoint": "http://127.0.0.1:{0}/rest".format(rest.server_address[1])}
+    cfg.update(json.loads(args.options))
+    listener = MqttListener()
+    if not listener.reload_configuration(cfg):
+        raise SystemExit("listener failed to load its configuration")
+    listener.start()
+
+    publisher = mqtt.Client()
+    publisher.connect('127.0.0.1', broker.server_address[1], 60)
+    publisher.loop_start()
+    time.sleep(1)
+
+    messages = 0
+    seq = 0
+    start = time.time()
+    for w in range(args.windows):
+        stamp = datetime.utcnow().isoformat() + "Z"
+        for r in range(args.receivers):
+            receiver = "R{0}".format(r)
+            values = []
+            for b in range(args.beacons):
+                seq += 1
+                values.append({"field": "rssi", "amount": -float(seq),
+                               "attributes": {"beacon": "B{0}".format(b), "receiver": receiver}})
+            groups = [[v] for v in values] if args.per_beacon else [values]
+            now = time.time()
+            with rest.lock:
+                for v in values:
+                    rest.sent[v['amount']] = now
+            for g in groups:
+                publisher.publish("sdw/Bench/{0}/value".format(receiver), json.dumps({"datetime": stamp, "values": g}))
+                messages += 1
+            publisher.publish("sdw/Bench/{0}/status".format(receiver),
+                              json.dumps({"status": "RUNNING", "attributes": {"receiver": receiver}}))
+            messages += 1
+        if args.interval:
+            time.sleep(args.interval)
+
+    # wait until every value was posted, or nothing has been posted for a while
+    deadline = time.time() + args.timeout
+    last_change, last_outstanding = time.time(), None
+    while time.time() < deadline:
+        with rest.lock:
+            outstanding = len(rest.sent)
+        if outstanding == 0:
+            break
+        if outstanding != last_outstanding:
+            last_change, last_outstanding = time.time(), outstanding
+        elif time.time() - last_change > 5:
+            break
+        time.sleep(0.05)
+    elapsed = time.time() - start
+    stats = listener.ingest_stats()
+    publisher.loop_stop()
+    listener.stop()
+
+    print "messages           {0} ({1} values) in {2:.2f}s".format(messages, seq, elapsed)
+    print "messages/sec       {0:.0f}".format(messages / elapsed)
+    print "values/sec         {0:.0f}".format(len(rest.latencies) / elapsed)
+    print "REST calls/message {0:.3f} ({1} posts, {2} gets)".format(float(rest.posts + rest.gets) / messages,
+                                                                   rest.posts, rest.gets)
+    print "latency p50/p99    {0:.1f}ms / {1:.1f}ms".format(percentile(rest.latencies, 0.5) * 1000,
+                                                            percentile(rest.latencies, 0.99) * 1000)
+    print "not posted         {0}".format(len(rest.sent))
+    print "ingest             {0}".format(json.dumps(stats))
@@ -0,0 +1,54 @@
+import time
+import signal
+import argparse
+import paho.mqtt.client as mqtt
+from MqttCapture import CaptureWriter
+from MqttListener import parse_server
+
+'''
+' Record MQTT traffic to a capture file for mqtt-replay.py
+'
+' Subscribes to the same topic tree as MqttListener and writes every message with its
+' topic and arrival time until interrupted, or for -d seconds / -n messages.
+'
+' Run with: python mqtt-capture.py -s tcp://broker:1883 -t 'sdw/#' -z -d 600 site.btmc
+'''
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="record MQTT messages to a capture file")
+    ap.add_argument("capture")
+    ap.add_argument("-s", "--server", default="tcp://localhost:1883")
+    ap.add_argument("-t", "--topic", default="sdw/#")
+    ap.add_argument("-z", "--compress", action="store_true", help="gzip the capture")
+    ap.add_argument("-d", "--duration", type=float, default=0, help="seconds to record, 0 until interrupted")
+    ap.add_argument("-n", "--messages", type=int, default=0, help="messages to record, 0 for no limit")
+    args = ap.parse_args()
+
+    writer = CaptureWriter(args.capture, args.compress)
+    host, port = parse_server(args.server)
+    done = []
+
+    def on_connect(client, userdata, flags, rc):
+        client.subscribe(args.topic)
+
+    def on_message(client, userdata, msg):
+        writer.write(msg.topic, msg.payload)
+        if args.messages and writer.stats()['messages'] >= args.messages:
+            done.append(True)
+
+    signal.signal(signal.SIGINT, lambda signum, frame: done.append(True))
+    client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(host, port, 60)
+    client.loop_start()
+    start = time.time()
+    while not done and (not args.duration or time.time() - start < args.duration):
+        time.sleep(0.1)
+    client.loop_stop()
+    writer.close()
+
+    stats = writer.stats()
+    print "recorded {0} messages ({1} bytes before compression) in {2:.1f}s".format(
+        stats['messages'], stats['bytes'], time.time() - start)
@@ -1,11 +1,10 @@
 import paho.mqtt.client as mqtt
-import requests
 import json
 import time
 from datetime import datetime
-from urllib import urlopen
 from dateutil import parser
 import calendar
+from RestSession import RestSession
 
 '''
 ' Uses dateutil package, installed with 'pip install python-dateutil'
@@ -13,6 +12,7 @@ import calendar
 
 beacon_index = {}
 receiver_index = {}
+rest = RestSession("http://localhost/rest")
 
 # The callback for when the client receives a CONNACK response from the server.
 def on_connect(client, userdata, flags, rc):
@@ -57,8 +57,8 @@ def on_message(client, userdata, msg):
                         'field_timestamp': unix_time
                     }
                 }
-                fp = urlopen("http://localhost/rest/bt_beacon_detection", data="json="+json.dumps(update))
-                print "[{0}]: {1}".format(datetime.now().strftime('%r'),fp.read())
+                r = rest.post("/bt_beacon_detection", update)
+                print "[{0}]: {1}".format(datetime.now().strftime('%r'),r.text)
             else:
                 print "Missing needed attributes: {0}".format(o)
     elif 'status' in msg.topic:
@@ -75,15 +75,15 @@ def on_message(client, userdata, msg):
                     'field_receiver_status': o['status']
                 }
             }
-            fp = urlopen("http://localhost/rest/bt_receiver", data="json="+json.dumps(update))
-            print fp.read()
+            r = rest.post("/bt_receiver", update)
+            print r.text
         else:
             print "Missing needed attributes: {0}".format(o)
         
 # Load all of the known entities of a given type into an index
 def load_objects(content_type,key,fields):
     index = {}
-    r = requests.get('http://localhost/rest/query/' + content_type)
+    r = rest.get('/query/' + content_type)
     if r.ok:
         for o in r.json():
             obj = {}
@@ -1,6 +1,7 @@
 from flask import Flask
 from flask import request
 from MqttListener import MqttListener
+from ListenerGroup import ListenerGroup
 import json
 import sys
 import traceback
@@ -18,6 +19,10 @@ import os
 ' start:  curl -X GET http://localhost:5000/start
 ' stop:   curl -X GET http://localhost:5000/stop
 ' status: curl -X GET http://localhost:5000
+' live:   curl -X GET http://localhost:5000/beacons/<title>, http://localhost:5000/receivers/<title>
+'
+' With "shard_workers" above 1 in the configuration the listener runs as a group of
+' worker processes (see ListenerGroup); start, stop and status apply to the group.
 '''
 
 app = Flask(__name__)
@@ -37,7 +42,7 @@ def init():
     try:
         with open(config_stash,"r") as fp:
             cfg = json.load(fp)
-            listener = MqttListener()
+            listener = create_listener(cfg, None)
             if listener.reload_configuration(cfg):
                 config_loaded = True
                 
@@ -47,6 +52,17 @@ def init():
         logger.warning(e, exc_info=True)
         logger.warning("[%s] startup error not-fatal, starting up", str(datetime.now()))
     
+
+# a single listener, or a group of worker processes when "shard_workers" is above 1
+def create_listener(cfg, current):
+    sharded = int(cfg.get('shard_workers', 1)) > 1
+    if current is not None and isinstance(current, ListenerGroup) == sharded:
+        return current
+    if current is not None and current._running:
+        current.stop()
+    return ListenerGroup() if sharded else MqttListener()
+
+
 @app.route('/status')
 def running_status():
     global listener
@@ -65,10 +81,35 @@ def running_status():
     else:
         topic = listener._cfg['topic']
         
-    status = {"status": s, "topic": topic}
+    if listener is None:
+        ingest = {}
+    else:
+        ingest = listener.ingest_stats()
+
+    status = {"status": s, "topic": topic, "ingest": ingest}
     return json.dumps(status)
 
 
+# latest detections of a beacon, from the listener's in-memory live state
+@app.route('/beacons/<id>')
+def beacon_state(id):
+    global listener
+    state = None if listener is None else listener.beacon_state(id)
+    if state is None:
+        return json.dumps({"status":"failure", "reason":"Beacon not seen recently"}), 404
+    return json.dumps(state)
+
+
+# latest status of a receiver and the beacons it heard, from the live state
+@app.route('/receivers/<id>')
+def receiver_state(id):
+    global listener
+    state = None if listener is None else listener.receiver_state(id)
+    if state is None:
+        return json.dumps({"status":"failure", "reason":"Receiver not seen recently"}), 404
+    return json.dumps(state)
+
+
 @app.route('/config', methods=['POST'])
 def load_config():
     global request, config_loaded, confg_stash, listener
@@ -76,8 +117,8 @@ def load_config():
         data = json.loads(request.data)
         with open(config_stash,"w") as fp:
             json.dump(data,fp)
-        listener.reload_configuration(data)
-        config_loaded = True
+        listener = create_listener(data, listener)
+        config_loaded = listener.reload_configuration(data)
         return json.dumps({"status":"success"})
     except Exception as e:
         return handle_exception(e)
@@ -89,15 +130,16 @@ def start_publishing():
     try:
         if not config_loaded:
             return json.dumps({"status":"failure", "reason":"No configuration loaded"})
+        elif not listener.start():
+            return json.dumps({"status":"failure", "reason":"Listener not ready to run"})
         else:
-            listener.start()
             return json.dumps({"status":"success"})
     except Exception as e:
         return handle_exception(e)
 
         
 @app.route('/stop')
-def stop_publishing(ind):
+def stop_publishing():
     global listener
     try:
         listener.stop()
@@ -0,0 +1,174 @@
+import json
+import time
+import urlparse
+import argparse
+import logging
+from threading import Thread, Lock
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from MqttCapture import read_capture
+from MqttListener import MqttListener
+
+'''
+' Replay a capture from mqtt-capture.py through MqttListener
+'
+' Messages are fed to the listener's on_message in their recorded order, at the
+' recorded pace (-s 1), N times faster (-s N) or as fast as possible (-s 0). No broker
+' is needed, and the REST backend is a local stand-in that knows every beacon and
+' receiver named in the capture and accepts every post, or fails a fraction of them
+' with --fail-rate to exercise the retry paths.
+'
+' Reports replay throughput, how far replay fell behind the recorded pace, and the
+' ingest, poster and REST counters including drops and errors.
+'
+' Run with: python mqtt-replay.py -s 10 site.btmc
+'
+' Listener options can be passed as JSON, eg: -o '{"detection_coalesce": 1}'
+'''
+
+
+class Message:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+
+class Rest(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, beacons, receivers, fail_rate):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), RestHandler)
+        self.lock = Lock()
+        self.objects = {"bt_beacon": [{"title": b, "nid": 100000 + i} for i, b in enumerate(sorted(beacons))],
+                        "bt_receiver": [{"title": r, "nid": i} for i, r in enumerate(sorted(receivers))]}
+        self.fail_every = int(round(1 / fail_rate)) if fail_rate > 0 else 0
+        self.gets = 0
+        self.posts = 0
+        self.rows = 0
+        self.failed = 0
+
+
+
+class RestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # send each reply in one write, unbuffered header lines stall on delayed ACKs
+    wbufsize = -1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.gets += 1
+        self.reply(200, json.dumps(self.server.objects.get(self.path.split('/')[-1], [])))
+
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with self.server.lock:
+            self.server.posts += 1
+            fail = self.server.fail_every and self.server.posts % self.server.fail_every == 0
+            if fail:
+                self.server.failed += 1
+            else:
+                update = json.loads(urlparse.parse_qs(body)['json'][0])
+                self.server.rows += len(update) if isinstance(update, list) else 1
+        if fail:
+            self.reply(503, '{"status":"unavailable"}')
+        else:
+            self.reply(200, '{"status":"ok"}')
+
+
+    def reply(self, code, text):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+
+    def log_message(self, *args):
+        pass
+
+
+
+# beacon and receiver titles named in the capture's value and status messages
+def capture_names(filename):
+    beacons, receivers = set(), set()
+    for arrival, topic, payload in read_capture(filename):
+        try:
+            o = json.loads(payload)
+        except ValueError:
+            continue
+        values = o.get('values', []) if isinstance(o, dict) else []
+        for attributes in [ v.get('attributes', {}) for v in values ] + [o.get('attributes', {})]:
+            if 'beacon' in attributes:
+                beacons.add(attributes['beacon'])
+            if 'receiver' in attributes:
+                receivers.add(attributes['receiver'])
+    return beacons, receivers
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="replay a capture file through MqttListener")
+    ap.add_argument("capture")
+    ap.add_argument("-s", "--speed", type=float, default=1, help="replay speed, 0 for as fast as possible")
+    ap.add_argument("-o", "--options", default="{}", help="extra listener configuration as JSON")
+    ap.add_argument("-f", "--fail-rate", type=float, default=0, help="fraction of REST posts to fail")
+    ap.add_argument("-t", "--timeout", type=float, default=30, help="seconds to wait for the listener to drain")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    beacons, receivers = capture_names(args.capture)
+    rest = Rest(beacons, receivers, args.fail_rate)
+    t = Thread(target=rest.serve_forever)
+    t.daemon = True
+    t.start()
+
+    cfg = {"server": "localhost", "keepalive": 60, "topic": "sdw/#", "detection_retries": 1,
+           "object_endpoint": "http://127.0.0.1:{0}/rest".format(rest.server_address[1])}
+    cfg.update(json.loads(args.options))
+    listener = MqttListener()
+    if not listener.reload_configuration(cfg, connect=False) or not listener.start():
+        raise SystemExit("listener failed to start")
+
+    messages = 0
+    lag = 0.0
+    first = None
+    start = time.time()
+    for arrival, topic, payload in read_capture(args.capture):
+        if first is None:
+            first = arrival
+        if args.speed > 0:
+            behind = time.time() - (start + (arrival - first) / args.speed)
+            if behind < 0:
+                time.sleep(-behind)
+            lag = max(lag, behind)
+        listener.on_message(None, None, Message(topic, payload))
+        messages += 1
+    fed = time.time() - start
+
+    # let the pipeline and the poster drain before reading the counters
+    deadline = time.time() + args.timeout
+    while time.time() < deadline:
+        stats = listener.ingest_stats()
+        queue = stats['queue']
+        if queue['depth'] == 0 and queue['processed'] + queue['dropped'] >= messages and stats['poster']['pending'] == 0:
+            break
+        time.sleep(0.05)
+    pipeline, poster = listener._pipeline, listener._poster
+    listener.stop()
+    elapsed = time.time() - start
+    queue, poster = pipeline.stats(), poster.stats()
+
+    recorded = (arrival - first) if messages else 0.0
+    print "messages           {0} ({1} beacons, {2} receivers), recorded over {3:.1f}s".format(
+        messages, len(beacons), len(receivers), recorded)
+    print "replayed in        {0:.2f}s ({1:.2f}s including drain)".format(fed, elapsed)
+    print "messages/sec       {0:.0f}".format(messages / elapsed if elapsed else 0)
+    if args.speed > 0:
+        print "max lag            {0:.1f}ms behind the recorded pace".format(lag * 1000)
+    print "ingest             processed {0}, dropped {1}, errors {2}".format(
+        queue['processed'], queue['dropped'], queue['errors'])
+    print "detections         posted {0}, failed {1}, absorbed {2}, dropped {3}".format(
+        poster['posted'], poster['failed'], poster['absorbed'], poster['dropped'])
+    print "REST               {0} posts ({1} failed), {2} rows, {3} gets".format(
+        rest.posts, rest.failed, rest.rows, rest.gets)
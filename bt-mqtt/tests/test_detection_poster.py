@@ -0,0 +1,169 @@
+import json
+import time
+import urlparse
+import unittest
+from threading import Thread, Lock
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from DetectionPoster import DetectionPoster
+from RestSession import RestSession
+
+
+# local stand-in for the REST backend, failing the first "fail" posts with a 503
+class Rest(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, fail=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), RestHandler)
+        self.lock = Lock()
+        self.fail = fail
+        self.attempts = 0
+        self.bodies = []
+
+
+
+class RestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with self.server.lock:
+            self.server.attempts += 1
+            fail = self.server.attempts <= self.server.fail
+            if not fail:
+                self.server.bodies.append(json.loads(urlparse.parse_qs(body)['json'][0]))
+        if fail:
+            self.reply(503, '{"status":"unavailable"}')
+        else:
+            self.reply(200, '{"status":"ok"}')
+
+
+    def reply(self, code, text):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+
+    def log_message(self, *args):
+        pass
+
+
+
+def detection(i, beacon="b1"):
+    return {"keys": {"field_beacon": beacon, "field_receiver": "r1", "field_detection_mode": "live"},
+            "values": {"field_rssi": -60 - i, "field_timestamp": 1000 + i}}
+
+
+
+class DetectionPosterTest(unittest.TestCase):
+    def setUp(self):
+        self.rest = None
+        self.session = None
+        self.poster = None
+
+
+    def tearDown(self):
+        if self.poster is not None:
+            self.poster.stop()
+        if self.session is not None:
+            self.session.close()
+        if self.rest is not None:
+            self.rest.shutdown()
+            self.rest.server_close()
+
+
+    def start(self, fail=0, run=True, **kwargs):
+        self.rest = Rest(fail)
+        t = Thread(target=self.rest.serve_forever, args=(0.05,))
+        t.daemon = True
+        t.start()
+        self.session = RestSession("http://127.0.0.1:{0}".format(self.rest.server_address[1]), retries=0)
+        self.poster = DetectionPoster(self.session, "/bt_beacon_detection", **kwargs)
+        if run:
+            self.poster.start()
+        return self.poster
+
+
+    # wait for the poster to settle, up to timeout seconds
+    def wait(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+
+
+    def rows(self):
+        return sum([ b if isinstance(b, list) else [b] for b in self.rest.bodies ], [])
+
+
+    def test_flush_on_size(self):
+        poster = self.start(flush_size=3, max_latency=60)
+        for i in range(3):
+            poster.add(detection(i, "b{0}".format(i)))
+        self.wait(lambda: self.rest.bodies)
+        self.assertEqual(len(self.rest.bodies), 1)
+        self.assertEqual(len(self.rest.bodies[0]), 3)
+        self.assertEqual(poster.stats()['posted'], 3)
+
+
+    def test_flush_on_age(self):
+        poster = self.start(flush_size=50, max_latency=0.2)
+        poster.add(detection(0))
+        poster.add(detection(1))
+        time.sleep(0.05)
+        self.assertEqual(self.rest.bodies, [])
+        self.wait(lambda: self.rest.bodies)
+        self.assertEqual(len(self.rows()), 2)
+
+
+    def test_retry_then_post(self):
+        poster = self.start(fail=1, flush_size=1, retries=3, retry_delay=0.01)
+        poster.add(detection(0))
+        self.wait(lambda: poster.stats()['posted'])
+        self.assertEqual(self.rest.attempts, 2)
+        self.assertEqual(self.rows(), [detection(0)])
+
+
+    def test_retry_then_drop(self):
+        poster = self.start(fail=100, flush_size=1, retries=3, retry_delay=0.01)
+        poster.add(detection(0))
+        self.wait(lambda: poster.stats()['failed'])
+        self.assertEqual(self.rest.attempts, 3)
+        self.assertEqual(poster.stats()['failed'], 1)
+        self.assertEqual(poster.stats()['posted'], 0)
+
+
+    def test_flush_on_stop(self):
+        poster = self.start(flush_size=50, max_latency=60)
+        poster.add(detection(0))
+        poster.add(detection(1))
+        poster.stop()
+        self.poster = None
+        self.assertEqual(self.rows(), [detection(0), detection(1)])
+
+
+    def test_max_pending(self):
+        poster = self.start(run=False, flush_size=10, max_pending=20)
+        for i in range(25):
+            poster.add(detection(i, "b{0}".format(i)))
+        self.assertEqual(poster.stats()['dropped'], 10)
+        self.assertEqual(poster.pending(), 15)
+        poster.flush()
+        self.assertEqual([ r['values']['field_timestamp'] for r in self.rows() ], range(1010, 1025))
+
+
+    def test_max_pending_coalesced(self):
+        poster = self.start(run=False, flush_size=10, max_pending=20, coalesce=60)
+        for i in range(25):
+            poster.add(detection(i, "b{0}".format(i)))
+        poster.add(detection(30, "b24"))
+        self.assertEqual(poster.stats()['dropped'], 10)
+        self.assertEqual(poster.stats()['absorbed'], 1)
+        poster.flush()
+        self.assertEqual(self.rows()[-1], detection(30, "b24"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import zlib
+import time
+import unittest
+from threading import Lock, current_thread
+from IngestPipeline import IngestPipeline
+
+
+class IngestPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.lock = Lock()
+        self.seen = {}
+        self.threads = set()
+
+
+    def handle(self, topic, payload, arrival):
+        time.sleep(0.0002)
+        with self.lock:
+            self.seen.setdefault(topic, []).append(payload)
+            self.threads.add(current_thread().name)
+
+
+    # the paths ListenerGroup's dispatcher sends to its first of shards worker processes
+    def shard_paths(self, shards, count):
+        paths = ( "sdw/Site/Receiver{0}".format(i) for i in xrange(100000) )
+        return [ p for p in paths if zlib.crc32(p) % shards == 0 ][:count]
+
+
+    def test_order_and_spread_within_a_shard(self):
+        for shards in [4, 8]:
+            self.seen, self.threads = {}, set()
+            paths = self.shard_paths(shards, 50)
+            pipeline = IngestPipeline(self.handle, queue_size=100000, workers=4)
+            pipeline.start()
+            for i in xrange(2000):
+                pipeline.submit(paths[i % len(paths)] + "/value", i)
+            pipeline.stop()
+            self.assertEqual(sum(len(p) for p in self.seen.values()), 2000)
+            for topic, payloads in self.seen.items():
+                self.assertEqual(payloads, sorted(payloads))
+            self.assertEqual(len(self.threads), 4)
+
+
+    def test_drop_oldest(self):
+        pipeline = IngestPipeline(self.handle, queue_size=2, workers=1)
+        for i in range(3):
+            pipeline.submit("sdw/Site/Receiver/value", i)
+        pipeline.start()
+        pipeline.stop()
+        self.assertEqual(self.seen["sdw/Site/Receiver/value"], [1, 2])
+        self.assertEqual(pipeline.stats()['dropped'], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
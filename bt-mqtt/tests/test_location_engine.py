@@ -0,0 +1,74 @@
+import unittest
+
+try:
+    from LocationEngine import LocationEngine
+    HAVE_NUMPY = True
+except ImportError:
+    HAVE_NUMPY = False
+
+
+class Poster:
+    def __init__(self):
+        self.updates = []
+
+
+    def add(self, update):
+        self.updates.append(update)
+
+
+
+@unittest.skipUnless(HAVE_NUMPY, "NumPy is not installed")
+class LocationEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.poster = Poster()
+        self.engine = LocationEngine(self.poster, max_age=10,
+                                     positions={"r1": [0.0, 0.0], "r2": [10.0, 0.0]})
+
+
+    def located(self, now):
+        del self.poster.updates[:]
+        self.engine.tick(now)
+        return dict((u['keys']['field_beacon'], u['values']) for u in self.poster.updates)
+
+
+    def test_nearest_receiver(self):
+        self.engine.update(1, "r1", 101, -80, 1000.0)
+        self.engine.update(1, "r2", 102, -60, 1000.0)
+        located = self.located(1001.0)
+        self.assertEqual(located[1]['field_receiver'], 102)
+        self.assertEqual(located[1]['field_receivers'], 2)
+        self.assertTrue(located[1]['field_x'] > 5.0)
+
+
+    # only beacons updated since the last tick are posted again
+    def test_updated_beacons_only(self):
+        self.engine.update(1, "r1", 101, -70, 1000.0)
+        self.engine.update(2, "r1", 101, -70, 1000.0)
+        self.assertEqual(sorted(self.located(1001.0)), [1, 2])
+        self.engine.update(2, "r2", 102, -65, 1001.5)
+        self.assertEqual(sorted(self.located(1002.0)), [2])
+        self.assertEqual(self.located(1003.0), {})
+
+
+    # a detection handled after a tick, but received before it, is still located
+    def test_detection_queued_past_a_tick(self):
+        self.engine.update(1, "r1", 101, -70, 1000.0)
+        self.located(1001.0)
+        self.engine.update(1, "r2", 102, -60, 1000.5)
+        located = self.located(1002.0)
+        self.assertEqual(located[1]['field_receiver'], 102)
+
+
+    def test_stale_detections_ignored(self):
+        self.engine.update(1, "r1", 101, -70, 1000.0)
+        self.assertEqual(self.located(1020.0), {})
+
+
+    def test_many_beacons(self):
+        for b in range(40):
+            self.engine.update(b, "r1", 101, -70, 1000.0)
+        self.assertEqual(len(self.located(1001.0)), 40)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+from BeaconData import Deadband
+
+
+def decisions(deadband, values, slot=0):
+    return [ deadband.should_publish(slot, v) for v in values ]
+
+
+
+class DeadbandTest(unittest.TestCase):
+    def test_absolute(self):
+        d = Deadband([2.0], [None], [100])
+        self.assertEqual(decisions(d, [-70, -71, -69, -73, -72]), [True, False, False, True, False])
+        self.assertEqual(d.stats(), {"sent": 2, "suppressed": 3, "heartbeats": 0})
+
+
+    def test_relative(self):
+        d = Deadband([None], [0.1], [100])
+        self.assertEqual(decisions(d, [-70, -75, -78, -60]), [True, False, True, True])
+
+
+    # a heartbeat of N suppresses N quiet windows and publishes the next one
+    def test_heartbeat(self):
+        d = Deadband([5.0], [None], [3])
+        self.assertEqual(decisions(d, [-70] * 9), [True, False, False, False, True, False, False, False, True])
+        self.assertEqual(d.stats(), {"sent": 3, "suppressed": 6, "heartbeats": 2})
+
+
+    def test_heartbeat_one(self):
+        d = Deadband([5.0], [None], [1])
+        self.assertEqual(decisions(d, [-70] * 5), [True, False, True, False, True])
+
+
+    def test_no_deadband(self):
+        d = Deadband([None], [None], [3])
+        self.assertEqual(decisions(d, [-70] * 3), [True] * 3)
+
+
+    def test_carry(self):
+        old = Deadband([5.0, 5.0], [None, None], [10, 10])
+        decisions(old, [-70, -70], slot=1)
+        new = Deadband([5.0], [None], [10])
+        new.carry(old, [(0, 1)])
+        self.assertEqual(decisions(new, [-71]), [False])
+        self.assertEqual(new.stats()['suppressed'], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import re
+import json
+import unittest
+import paho.mqtt.client as mqtt
+
+try:
+    import sdw
+    HAVE_SDW = hasattr(getattr(sdw, 'MQTT', None), 'publish_values')
+except ImportError:
+    HAVE_SDW = False
+
+
+# messages handed to any paho client while a test runs, as (topic, payload, qos, retain)
+sent = []
+
+
+def record_publish(client, topic, payload=None, qos=0, retain=False, properties=None):
+    sent.append((topic, payload, qos, retain))
+    info = mqtt.MQTTMessageInfo(len(sent))
+    info.rc = mqtt.MQTT_ERR_SUCCESS
+    return info
+
+
+def ignore(*args, **kwargs):
+    return mqtt.MQTT_ERR_SUCCESS
+
+
+
+class PahoTestCase(unittest.TestCase):
+    # publishing goes through paho, which is kept off the network
+    def setUp(self):
+        self.patched = {}
+        for name, fn in [("publish", record_publish), ("connect", ignore), ("connect_async", ignore),
+                         ("reconnect", ignore), ("loop_start", ignore), ("loop_stop", ignore),
+                         ("loop_forever", ignore), ("disconnect", ignore)]:
+            self.patched[name] = getattr(mqtt.Client, name)
+            setattr(mqtt.Client, name, fn)
+        del sent[:]
+        from MqttConnections import BrokerConnection, PathPublisher
+        self.connection = BrokerConnection("localhost", 1883)
+        self.shared = PathPublisher(self.connection, "/Site/Room/Beacon")
+
+
+    def tearDown(self):
+        self.connection.close()
+        for name, fn in self.patched.items():
+            setattr(mqtt.Client, name, fn)
+
+
+    # the last message published by fn
+    def published(self, fn):
+        del sent[:]
+        fn()
+        self.assertTrue(sent)
+        topic, payload, qos, retain = sent[-1]
+        return topic, json.loads(payload), qos, retain
+
+
+
+class PathPublisherFormatTest(PahoTestCase):
+    # the SA wire format PathPublisher reproduces, checked where sdw is not installed too
+    def test_value_message(self):
+        values = [self.shared.create_value("rssi", -61.5)]
+        self.assertEqual(values, [{"field": "rssi", "amount": -61.5, "attributes": {}}])
+        topic, payload, qos, retain = self.published(lambda: self.shared.publish_values(values))
+        self.assertEqual(topic, "sdw/Site/Room/Beacon/value")
+        self.assertEqual(sorted(payload.keys()), ["datetime", "values"])
+        self.assertEqual(payload['values'], values)
+        self.assertTrue(re.match(r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(\.\d+)?Z$', payload['datetime']))
+        self.assertEqual((qos, retain), (0, False))
+
+
+    def test_status_message(self):
+        topic, payload, qos, retain = self.published(lambda: self.shared.publish_status("RUNNING"))
+        self.assertEqual(topic, "sdw/Site/Room/Beacon/status")
+        self.assertEqual(payload, {"status": "RUNNING", "message": ""})
+        self.assertEqual((qos, retain), (0, False))
+
+
+
+@unittest.skipUnless(HAVE_SDW, "sdw is not installed")
+class PathPublisherTest(PahoTestCase):
+    # PathPublisher against sdw.MQTT for the same inputs
+    def setUp(self):
+        PahoTestCase.setUp(self)
+        self.vendor = sdw.MQTT("localhost", 1883, "/Site/Room/Beacon")
+
+
+    def test_create_value(self):
+        for field, value in [("rssi", -61.5), ("temperature", 41.0), ("count", 3)]:
+            self.assertEqual(self.shared.create_value(field, value), self.vendor.create_value(field, value))
+
+
+    def test_create_status_payload(self):
+        for status, message in [("RUNNING", ""), ("NOT_RUNNING", "stopped")]:
+            self.assertEqual(self.shared.create_status_payload(status, message),
+                             self.vendor.create_status_payload(status, message))
+
+
+    def test_publish_values(self):
+        values = [self.vendor.create_value("rssi", -61.5), self.vendor.create_value("temperature", 41.0)]
+        shared = self.published(lambda: self.shared.publish_values(values))
+        vendor = self.published(lambda: self.vendor.publish_values(values))
+        self.assertEqual(shared[0], vendor[0])
+        self.assertEqual(shared[2:], vendor[2:])
+        self.assertEqual(sorted(shared[1].keys()), sorted(vendor[1].keys()))
+        self.assertEqual(shared[1]['values'], vendor[1]['values'])
+        # same datetime layout, the instants differ
+        self.assertEqual(re.sub(r'\d', '0', shared[1]['datetime']), re.sub(r'\d', '0', vendor[1]['datetime']))
+
+
+    def test_publish_status(self):
+        shared = self.published(lambda: self.shared.publish_status("RUNNING"))
+        vendor = self.published(lambda: self.vendor.publish_status("RUNNING"))
+        self.assertEqual(shared, vendor)
+
+
+if __name__ == "__main__":
+    unittest.main()
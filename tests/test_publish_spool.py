@@ -0,0 +1,84 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from PublishSpool import PublishSpool, _HEADER, _LENGTH
+
+
+def message(i):
+    return {"datetime": "2020-01-01T00:00:00Z", "values": [{"field": "rssi", "amount": i}]}
+
+
+# bytes one spooled record of message(i) takes for a single digit i
+def record_size():
+    return _LENGTH.size + len(json.dumps({"mqtt": "localhost", "path": "/p", "message": message(0)}))
+
+
+
+class PublishSpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "spool")
+        # room for exactly three records, so the third one ends at the end of the ring
+        self.size = _HEADER.size + 3 * record_size()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+    def reopen(self, spool):
+        spool.close()
+        return PublishSpool(self.filename, self.size)
+
+
+    def test_reopen_with_tail_at_end_of_ring(self):
+        spool = PublishSpool(self.filename, self.size)
+        for i in range(3):
+            self.assertTrue(spool.append("localhost", "/p", message(i)))
+        spool = self.reopen(spool)
+        self.assertEqual(spool.pending(), 3)
+        for i in range(3):
+            token, record = spool.peek()
+            self.assertEqual(record['message'], message(i))
+            spool.pop(token)
+        self.assertEqual(spool.pending(), 0)
+        spool.close()
+
+
+    def test_reopen_with_head_at_end_of_ring(self):
+        spool = PublishSpool(self.filename, self.size)
+        for i in range(3):
+            spool.append("localhost", "/p", message(i))
+        for i in range(2):
+            spool.pop(spool.peek()[0])
+        spool.append("localhost", "/p", message(3))
+        spool.pop(spool.peek()[0])
+        spool = self.reopen(spool)
+        self.assertEqual(spool.pending(), 1)
+        self.assertEqual(spool.peek()[1]['message'], message(3))
+        spool.append("localhost", "/p", message(4))
+        spool.pop(spool.peek()[0])
+        self.assertEqual(spool.peek()[1]['message'], message(4))
+        spool.close()
+
+
+    def test_reopen_header_written_at_capacity(self):
+        spool = PublishSpool(self.filename, self.size)
+        for i in range(3):
+            spool.append("localhost", "/p", message(i))
+        capacity = self.size - _HEADER.size
+        # a header from a spool that stored the end of the ring as the tail
+        _HEADER.pack_into(spool._map, 0, 'BTSP', 1, 0, capacity, 3)
+        spool._map.flush()
+        spool._map.close()
+        spool._fp.close()
+        spool = PublishSpool(self.filename, self.size)
+        self.assertEqual(spool.pending(), 3)
+        self.assertEqual(spool.peek()[1]['message'], message(0))
+        spool.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import random
+import unittest
+from StreamingStats import P2Quantile, TrimmedMean, create_estimator
+
+
+def samples(count=500, seed=7):
+    r = random.Random(seed)
+    return [ int(r.gauss(-70, 6)) for i in range(count) ]
+
+
+
+class StreamingStatsTest(unittest.TestCase):
+    # integer RSSI samples give the same estimates as the same samples as floats
+    def test_int_samples(self):
+        for create in [lambda: P2Quantile(0.5), lambda: P2Quantile(0.9), lambda: TrimmedMean(0.1)]:
+            ints, floats = create(), create()
+            for x in samples():
+                ints.add(x)
+                floats.add(float(x))
+            self.assertEqual(ints.value(), floats.value())
+
+
+    def test_median_estimate(self):
+        data = samples(2000)
+        median = P2Quantile(0.5)
+        for x in data:
+            median.add(x)
+        exact = sorted(data)[len(data) // 2]
+        self.assertTrue(abs(median.value() - exact) <= 1.0)
+
+
+    def test_few_samples_exact(self):
+        e = create_estimator("median", {})
+        for x in [-70, -60, -80]:
+            e.add(x)
+        self.assertEqual(e.value(), -70.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+from WindowHistory import WindowHistory, read_history
+
+
+def rows(paths):
+    return [ (p, "rssi", 3, -80.0, -60.0, -70.0, -65.0) for p in paths ]
+
+
+
+class WindowHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "history")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+    def test_read_range(self):
+        history = WindowHistory(self.filename)
+        for t in range(10):
+            history.append(1000.0 + t, rows(["/site/a", "/site/b"]))
+        history.close()
+        windows = read_history(self.filename, "/site/a", 1003, 1005)
+        self.assertEqual([ w['timestamp'] for w in windows ], [1003.0, 1004.0, 1005.0])
+        self.assertEqual(windows[0]['field'], "rssi")
+
+
+    # realistic SA paths for more beacons than the default name table holds
+    def test_names_beyond_default_table(self):
+        paths = [ "/site/building-{0:03d}/floor-02/zone-{0:03d}/beacon".format(i) for i in range(400) ]
+        history = WindowHistory(self.filename)
+        for t in range(5):
+            history.append(1000.0 + t, rows(paths))
+        history.close()
+        self.assertFalse(os.path.exists(self.filename + ".1"))
+        for p in [paths[0], paths[-1]]:
+            self.assertEqual(len(read_history(self.filename, p)), 5)
+
+        # the grown header is kept when the file is reopened
+        history = WindowHistory(self.filename)
+        history.append(1005.0, rows(paths))
+        history.close()
+        self.assertFalse(os.path.exists(self.filename + ".1"))
+        self.assertEqual(len(read_history(self.filename, paths[-1])), 6)
+
+
+    # a mapping that outgrows the table once windows are recorded rotates a single time
+    def test_names_added_after_records(self):
+        paths = [ "/site/building-{0:03d}/floor-02/zone-{0:03d}/beacon".format(i) for i in range(400) ]
+        history = WindowHistory(self.filename)
+        history.append(1000.0, rows(paths[:10]))
+        for t in range(1, 5):
+            history.append(1000.0 + t, rows(paths))
+        history.close()
+        self.assertTrue(os.path.exists(self.filename + ".1"))
+        self.assertFalse(os.path.exists(self.filename + ".2"))
+        self.assertEqual(len(read_history(self.filename, paths[0])), 5)
+        self.assertEqual(len(read_history(self.filename, paths[-1])), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()